@@ -0,0 +1,47 @@
+import sys
+import time
+import tensorflow as tf
+
+sys.path.append('.')
+from train import parse_opt
+from utils import list_images, get_image
+
+# run from the repository root with the usual train.py data arguments, e.g.
+#   python experiments/benchmark_fused_crop.py --source_dir ... --image_size 256 --crop_size 128 --bench_threads 1
+# reports training images/sec of the full decode, resize and crop path against --fused_crop
+
+
+def throughput(path_list, opt, fused, threads, num_images):
+    opt.fused_crop = fused
+    paths = tf.constant(path_list)
+    ds = tf.data.Dataset.range(num_images).map(lambda i: get_image(tf.gather(paths, i % len(path_list)), opt, True),
+                                               num_parallel_calls=threads).batch(opt.batch_size)
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = threads
+    ds = ds.with_options(options)
+
+    for _ in ds.take(2):
+        pass
+    start = time.perf_counter()
+    for _ in ds:
+        pass
+    return num_images / (time.perf_counter() - start)
+
+
+def main():
+    args = sys.argv[1:]
+    threads = int(args[args.index('--bench_threads') + 1]) if '--bench_threads' in args else 1
+    num_images = int(args[args.index('--bench_images') + 1]) if '--bench_images' in args else 2000
+    opt = parse_opt()
+    opt.batch_augment = False
+    path_list, _ = list_images(opt.source_dir, opt)
+
+    rates = {fused: throughput(path_list, opt, fused, threads, num_images) for fused in [False, True]}
+    for fused, rate in rates.items():
+        print(f'{"fused crop" if fused else "full decode":>11}  image_size {opt.image_size} crop_size {opt.crop_size}  '
+              f'{rate:8.1f} images/s  {rate / threads:8.1f} images/s per thread')
+    print(f'speedup {rates[True] / rates[False]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
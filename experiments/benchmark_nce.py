@@ -0,0 +1,66 @@
+import argparse
+import sys
+import tensorflow as tf
+
+sys.path.append('./models')
+from losses import patch_nce_loss
+from benchmark_utils import time_step, peak_memory_mb, run_worker
+
+
+def make_inputs(num_patches, batch_size, num_layers, units=256):
+    feats = []
+    for _ in range(2):
+        feat = tf.random.normal((num_layers, batch_size * num_patches, units))
+        feats.append(list(tf.math.l2_normalize(feat, axis=-1)))
+    ids = [tf.range(num_patches)] * num_layers
+    return feats[0], feats[1], ids
+
+
+def make_step(chunk_size, tau=0.07):
+    @tf.function
+    def step(feats_s, feats_t, ids):
+        with tf.GradientTape() as tape:
+            tape.watch([feats_s, feats_t])
+            loss = patch_nce_loss(feats_s, feats_t, ids, tau, chunk_size)
+        grad_s, grad_t = tape.gradient(loss, [feats_s, feats_t])
+        return [loss, tf.stack(grad_s), tf.stack(grad_t)]
+    return step
+
+
+def check(num_patches, batch_size, num_layers, chunk_size):
+    inputs = make_inputs(num_patches, batch_size, num_layers)
+    dense = make_step(0)(*inputs)
+    chunked = make_step(chunk_size)(*inputs)
+    for name, a, b in zip(['loss', 'd_source', 'd_target'], chunked, dense):
+        print(f'--{num_patches} patches: max abs diff {name}: {tf.reduce_max(tf.abs(a - b)).numpy():.2e}')
+
+
+def worker(chunk_size, num_patches, batch_size, num_layers, steps):
+    elapsed = time_step(make_step(chunk_size), make_inputs(num_patches, batch_size, num_layers), steps)
+    print(f'chunk {chunk_size:>5} {num_patches:>5} patches  {elapsed:9.2f} ms/step  peak {peak_memory_mb():8.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_patches', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[0, 256, 1024])
+    parser.add_argument('--batch_size', type=int, default=3)
+    parser.add_argument('--num_layers', type=int, default=6)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--worker', type=int, default=-1)
+    opt = parser.parse_args()
+
+    if opt.worker >= 0:
+        worker(opt.worker, opt.num_patches[0], opt.batch_size, opt.num_layers, opt.steps)
+        return
+
+    check(300, opt.batch_size, opt.num_layers, 64)
+    # the dense loss may run out of memory at large patch counts, the remaining measurements still run
+    for num_patches in opt.num_patches:
+        for chunk_size in opt.chunk_sizes:
+            run_worker(__file__, ['--worker', chunk_size, '--num_patches', num_patches, '--batch_size', opt.batch_size,
+                                  '--num_layers', opt.num_layers, '--steps', opt.steps], check=False)
+
+
+if __name__ == '__main__':
+    main()
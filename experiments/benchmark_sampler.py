@@ -0,0 +1,115 @@
+import argparse
+import sys
+import tensorflow as tf
+
+sys.path.append('./models')
+from warping import affine_grid_generator, bilinear_sampler
+from benchmark_utils import time_step, peak_memory_mb, run_worker
+
+
+def get_pixel_value(img, x, y):
+    shape = tf.shape(x)
+    batch_size = shape[0]
+    height = shape[1]
+    width = shape[2]
+    batch_idx = tf.range(0, batch_size)
+    batch_idx = tf.reshape(batch_idx, (batch_size, 1, 1))
+    b = tf.tile(batch_idx, (1, height, width))
+    indices = tf.stack([b, y, x], 3)
+    return tf.gather_nd(img, indices)
+
+
+def reference_bilinear_sampler(img, grids):
+    # the previous four gather_nd implementation, differentiated by autodiff
+    x, y = grids[:, 0, ...], grids[:, 1, ...]
+    H = tf.shape(img)[1]
+    W = tf.shape(img)[2]
+    max_y = tf.cast(H - 1, 'int32')
+    max_x = tf.cast(W - 1, 'int32')
+    zero = tf.zeros([], dtype='int32')
+
+    x = 0.5 * ((x + 1.0) * tf.cast(max_x - 1, 'float32'))
+    y = 0.5 * ((y + 1.0) * tf.cast(max_y - 1, 'float32'))
+
+    x0 = tf.cast(tf.floor(x), 'int32')
+    x1 = x0 + 1
+    y0 = tf.cast(tf.floor(y), 'int32')
+    y1 = y0 + 1
+
+    x0 = tf.clip_by_value(x0, zero, max_x)
+    x1 = tf.clip_by_value(x1, zero, max_x)
+    y0 = tf.clip_by_value(y0, zero, max_y)
+    y1 = tf.clip_by_value(y1, zero, max_y)
+
+    Ia = get_pixel_value(img, x0, y0)
+    Ib = get_pixel_value(img, x0, y1)
+    Ic = get_pixel_value(img, x1, y0)
+    Id = get_pixel_value(img, x1, y1)
+
+    x0 = tf.cast(x0, 'float32')
+    x1 = tf.cast(x1, 'float32')
+    y0 = tf.cast(y0, 'float32')
+    y1 = tf.cast(y1, 'float32')
+
+    wa = tf.expand_dims((x1 - x) * (y1 - y), axis=3)
+    wb = tf.expand_dims((x1 - x) * (y - y0), axis=3)
+    wc = tf.expand_dims((x - x0) * (y1 - y), axis=3)
+    wd = tf.expand_dims((x - x0) * (y - y0), axis=3)
+    return tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
+
+
+SAMPLERS = {'fused': bilinear_sampler, 'reference': reference_bilinear_sampler}
+
+
+def make_inputs(size, batch_size, channels=3):
+    img = tf.random.uniform((batch_size, size, size, channels), -1., 1.)
+    shift = tf.random.normal((batch_size, 2, size, size), stddev=0.05)
+    return img, affine_grid_generator(size, size) + shift
+
+
+def make_step(sampler):
+    @tf.function
+    def step(img, grids):
+        with tf.GradientTape() as tape:
+            tape.watch([img, grids])
+            out = sampler(img, grids)
+            loss = tf.reduce_mean(out ** 2)
+        return [out] + tape.gradient(loss, [img, grids])
+    return step
+
+
+def check(size, batch_size):
+    img, grids = make_inputs(size, batch_size)
+    fused = make_step(bilinear_sampler)(img, grids)
+    reference = make_step(reference_bilinear_sampler)(img, grids)
+    for name, a, b in zip(['out', 'd_img', 'd_grids'], fused, reference):
+        print(f'--{size}: max abs diff {name}: {tf.reduce_max(tf.abs(a - b)).numpy():.2e}')
+
+
+def worker(impl, size, batch_size, steps):
+    elapsed = time_step(make_step(SAMPLERS[impl]), make_inputs(size, batch_size), steps)
+    print(f'{impl:>9} {size:>4}px  {elapsed:8.2f} ms/step  peak {peak_memory_mb():8.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--batch_size', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--worker', type=str, default='')
+    opt = parser.parse_args()
+
+    if opt.worker:
+        worker(opt.worker, opt.sizes[0], opt.batch_size, opt.steps)
+        return
+
+    for size in opt.sizes:
+        check(size, opt.batch_size)
+    for size in opt.sizes:
+        for impl in SAMPLERS:
+            run_worker(__file__, ['--worker', impl, '--sizes', size, '--batch_size', opt.batch_size,
+                                  '--steps', opt.steps])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import resource
+import subprocess
+import sys
+import time
+import tensorflow as tf
+
+
+def time_step(step, inputs, steps):
+    # ms per call of a traced step, after one warm-up call that traces it
+    step(*inputs)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step(*inputs)[0].numpy()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def peak_memory_mb():
+    # peak device memory on a GPU, peak resident set size of the process otherwise
+    if tf.config.list_physical_devices('GPU'):
+        return tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_worker(script, args, check=True):
+    # every measurement runs in its own process so the peak memory is not shared
+    subprocess.run([sys.executable, script] + [str(a) for a in args], check=check)
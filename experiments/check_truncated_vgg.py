@@ -0,0 +1,41 @@
+import argparse
+import sys
+import yaml
+import tensorflow as tf
+from tensorflow.keras.applications.vgg16 import VGG16
+from tensorflow.keras.applications.vgg19 import VGG19
+
+sys.path.append('./models')
+from vgg import truncated_vgg, vgg_flops, vgg_layers
+
+ENCODERS = {'PCGAN': ('vgg19', VGG19), 'InfoMatch': ('vgg16', VGG16)}
+
+
+def reference_encoder(vgg, layer_ids):
+    # the previous encoder: the full keras VGG with outputs taken at the requested layers
+    vgg = vgg(include_top=False)
+    return vgg, tf.keras.Model(inputs=vgg.input, outputs=[vgg.layers[idx].output for idx in layer_ids])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=2)
+    opt = parser.parse_args()
+
+    x = tf.random.uniform((opt.batch_size, opt.size, opt.size, 3), -1., 1.)
+    for model, (arch, vgg) in ENCODERS.items():
+        layer_ids = yaml.safe_load(open(f'configs/{model}.yaml'))['per_layers']
+        truncated = truncated_vgg(arch, layer_ids)
+        vgg, reference = reference_encoder(vgg, layer_ids)
+        for idx, a, b in zip(layer_ids, truncated(x), reference(x)):
+            print(f'{model} layer {idx}: max abs diff {tf.reduce_max(tf.abs(a - b)).numpy():.2e}')
+
+        full = vgg_flops(arch, len(vgg_layers(arch)) - 1, opt.size, opt.size)
+        kept = vgg_flops(arch, max(layer_ids), opt.size, opt.size)
+        print(f'{model}: {len(truncated.weights)} of {len(vgg.weights)} weights kept, '
+              f'{kept / 1e9:.2f} of {full / 1e9:.2f} GFLOPs at {opt.size}x{opt.size}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import sys
+import yaml
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('.')
+sys.path.append('./models')
+from train import parse_opt
+from utils import build_dataset, calibration_images
+from models.modules import normalize_images
+from models.quantize import quantize_model
+from models.vgg import truncated_vgg
+from metrics.metrics import MetricsCallbacks, calculate_fid
+
+# run from the repository root with the usual train.py data arguments, e.g.
+#   python experiments/int8_deviation.py --model InfoMatch --source_dir ... --target_dir ... --calib_size 256
+# reports how far perceptual-loss values and FID move when the frozen encoders run in int8 on real images
+
+ENCODERS = {'PCGAN': 'vgg19', 'InfoMatch': 'vgg16'}
+
+
+def validation_pairs(opt):
+    _, ds_val = build_dataset(opt)
+    for xa, xb in ds_val:
+        xa, xb = normalize_images((xa, xb))
+        if opt.with_masks:
+            (xa, _), (xb, _) = xa, xb
+        yield xa, xb
+
+
+def perceptual_deviation(opt, calibration):
+    for model, arch in ENCODERS.items():
+        layer_ids = [idx for idx in yaml.safe_load(open(f'configs/{model}.yaml'))['per_layers'] if idx != 0]
+        encoder = truncated_vgg(arch, layer_ids)
+        quantized = quantize_model(encoder, calibration, f'{opt.cache_dir}/int8', arch)
+
+        # in validation the translated image goes through the float encoder and only the real one through int8,
+        # so xa stands in for the translation and the loss pairs float features with int8 features
+        losses = []
+        for xa, xb in validation_pairs(opt):
+            fake = encoder(xa)
+            reference = [tf.reduce_mean(tf.abs(a - b)) for a, b in zip(fake, encoder(xb))]
+            int8 = [np.mean(np.abs(a.numpy() - b)) for a, b in zip(fake, quantized(xb))]
+            losses.append([float(sum(reference)), float(sum(int8))])
+        losses = np.array(losses)
+        rel = np.abs(losses[:, 1] - losses[:, 0]) / np.maximum(losses[:, 0], 1e-8)
+        print(f'{model} {arch} perceptual loss: float {losses[:, 0].mean():.4f}  int8 {losses[:, 1].mean():.4f}  '
+              f'mean rel diff {rel.mean():.2e}  max rel diff {rel.max():.2e}')
+
+
+def fid_deviation(opt, calibration):
+    reference = MetricsCallbacks(None, opt, '')
+    quantized = MetricsCallbacks(None, opt, '', calibration=calibration)
+    scores = []
+    for metric in [reference, quantized]:
+        Ea, Eb = [], []
+        for xa, xb in validation_pairs(opt):
+            Ea.append(np.asarray(metric.inception_model(metric.preprocess(xa))[1], 'float32'))
+            Eb.append(np.asarray(metric.inception_model(metric.preprocess(xb))[1], 'float32'))
+        scores.append(calculate_fid(np.concatenate(Eb), np.concatenate(Ea)))
+    print(f'FID between domains: float {scores[0]:.3f}  int8 {scores[1]:.3f}  abs diff {abs(scores[1] - scores[0]):.3f}')
+
+
+def main():
+    opt = parse_opt()
+    calibration = calibration_images(opt)
+    perceptual_deviation(opt, calibration)
+    fid_deviation(opt, calibration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import json
+import subprocess
+import sys
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import callbacks, optimizers
+
+sys.path.append('.')
+from train import parse_opt
+from utils import load_model, build_dataset
+
+# run from the repository root with the usual train.py arguments, e.g.
+#   python experiments/precision_parity.py --model InfoMatch --source_dir ... --target_dir ...
+# each precision trains from the same seed for --parity_steps batches in its own process,
+# then the per-batch losses of both runs are compared
+
+
+class LossHistory(callbacks.Callback):
+    def __init__(self):
+        super().__init__()
+        self.history = []
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.history.append({k: float(v) for k, v in logs.items()})
+
+
+def worker(opt, steps, output):
+    tf.keras.utils.set_random_seed(opt.seed)
+    if opt.precision == 'bfloat16':
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    model, _ = load_model(opt)
+    ds_train, ds_val = build_dataset(opt)
+    model.compile(*[optimizers.Adam(learning_rate=opt.lr, beta_1=opt.beta_1, beta_2=opt.beta_2) for _ in range(4)])
+
+    history = LossHistory()
+    model.fit(ds_train.take(steps), epochs=1, callbacks=[history], verbose=0)
+    with open(output, 'w') as f:
+        json.dump(history.history, f)
+
+
+def main():
+    args = sys.argv[1:]
+    steps = int(args[args.index('--parity_steps') + 1]) if '--parity_steps' in args else 50
+    opt = parse_opt()
+    if '--parity_worker' in args:
+        worker(opt, steps, args[args.index('--parity_worker') + 1])
+        return
+
+    os.makedirs(opt.cache_dir, exist_ok=True)
+    curves = {}
+    for precision in ['float32', 'bfloat16']:
+        output = f'{opt.cache_dir}/parity_{opt.model}_{precision}.json'
+        subprocess.run([sys.executable, __file__] + args + ['--precision', precision, '--parity_worker', output],
+                       check=True)
+        with open(output) as f:
+            curves[precision] = f.read()
+
+    fp32, bf16 = [json.loads(curves[p]) for p in ['float32', 'bfloat16']]
+    for key in fp32[0]:
+        a = np.array([step[key] for step in fp32])
+        b = np.array([step[key] for step in bf16])
+        rel = np.abs(a - b) / np.maximum(np.abs(a), 1e-8)
+        print(f'{key:>10}: float32 {a[-1]:9.4f}  bfloat16 {b[-1]:9.4f}  '
+              f'mean rel diff {rel.mean():.2e}  max rel diff {rel.max():.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+from utils import *
+from train import parse_opt
+from tensorflow.keras import layers
+from modules import ConvBlock, ConvTransposeBlock, InstanceNorm  # the classes the models were built from
+
+
+def parse_export_opt():
+  opt = parse_opt()
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--export_dir', type=str, default='./exports')
+  parser.add_argument('--export_size', type=int, default=256, help='fixed input size of the exported graphs')
+  export_opt, _ = parser.parse_known_args()
+  opt.export_dir, opt.export_size = export_opt.export_dir, export_opt.export_size
+  return opt
+
+
+def translation_path(model, opt):
+  # the sub-networks that translate a source image, and the function chaining them at inference
+  if opt.model in ['PCGAN']:
+    def translate(x):
+      x_warped, _ = model.CP(x)
+      return model.R(x_warped)[0]
+    return [model.CP, model.R], translate
+
+  elif opt.model == 'InfoMatch':
+    def translate(x, mask):
+      x_warped, _ = model.CP([x, mask])
+      return model.R(x_warped)[0]
+    return [model.CP, model.R], translate
+
+  elif opt.model in ['CycleGAN', 'DCLGAN']:
+    return [model.Gb], lambda x: model.Gb(x)
+
+  elif opt.model == 'UGATIT':
+    return [model.Gb], lambda x: model.Gb(x)[0]
+
+  elif opt.model == 'UNIT':
+    return [model.Ga, model.Gb], lambda x: model.Gb.decode(model.Ga.encode(x)[0])
+
+  return [model.G], lambda x: model.G(x)
+
+
+def fold_normalization(nets):
+  # conv biases in front of an instance norm are cancelled by its mean subtraction and their add is dropped, and
+  # a batch norm with its moving statistics is a per-channel scale folded into the kernel plus a constant shift
+  # that absorbs the conv bias. keras checks use_bias when the call is traced, so this runs before tracing
+  folded = 0
+  for net in nets:
+    for block in net.submodules:
+      if not isinstance(block, (ConvBlock, ConvTransposeBlock)):
+        continue
+      conv = block.conv2d if isinstance(block, ConvBlock) else block.convT2d
+      norm = block.normalization
+
+      if isinstance(norm, InstanceNorm) and conv.use_bias:
+        conv.use_bias = False
+        folded += 1
+
+      elif isinstance(norm, layers.BatchNormalization):
+        scale = norm.gamma * tf.math.rsqrt(norm.moving_variance + norm.epsilon)
+        shift = norm.beta - norm.moving_mean * scale
+        if conv.use_bias:
+          shift += conv.bias * scale
+          conv.use_bias = False
+        # the output channels are the last kernel axis of a conv and the third of a transposed conv
+        conv.kernel.assign(conv.kernel * (scale if isinstance(block, ConvBlock) else scale[:, None]))
+        block.normalization = lambda x, shift=tf.constant(shift): x + shift
+        folded += 1
+  return folded
+
+
+def main():
+  opt = parse_export_opt()
+  model, params = load_model(opt)
+  ckpt = tf.train.latest_checkpoint(f"{opt.ckpt_dir}/{opt.model}/{params}")
+  model.load_weights(ckpt).expect_partial()
+
+  nets, translate = translation_path(model, opt)
+  signature = [tf.TensorSpec([1, opt.export_size, opt.export_size, opt.num_channels], tf.float32, name='image')]
+  if opt.model == 'InfoMatch':
+    signature.append(tf.TensorSpec([1, opt.export_size, opt.export_size, 1], tf.float32, name='mask'))
+
+  # one eager call creates the variables and runs the deferred checkpoint restore before folding
+  translate(*[tf.zeros(spec.shape) for spec in signature])
+  print(f'--folded {fold_normalization(nets)} normalisation layers')
+
+  module = tf.Module()
+  module.nets = nets
+  module.translate = tf.function(translate, input_signature=signature)
+
+  export_dir = f'{opt.export_dir}/{opt.model}/{params}'
+  tf.saved_model.save(module, f'{export_dir}/saved_model',
+                      signatures={'serving_default': module.translate.get_concrete_function()})
+
+  converter = tf.lite.TFLiteConverter.from_saved_model(f'{export_dir}/saved_model')
+  with open(f'{export_dir}/{opt.model}_{opt.export_size}.tflite', 'wb') as f:
+    f.write(converter.convert())
+  print(f'--exported {opt.model} from {ckpt} to {export_dir}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,61 @@
+import argparse
+import numpy as np
+from PIL import Image
+
+try:
+    # the standalone runtime loads in a fraction of the time of the full tensorflow package
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    from tensorflow.lite import Interpreter
+
+
+class Translator:
+    """ Runs a translation graph written by export.py on uint8 images. """
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        # inputs keep the names of the export signature, e.g. serving_default_image:0
+        inputs = self.interpreter.get_input_details()
+        self.image = next(d for d in inputs if 'image' in d['name'])
+        self.mask = next((d for d in inputs if 'mask' in d['name']), None)
+        self.output = self.interpreter.get_output_details()[0]
+        self.size = tuple(self.image['shape'][1:3])
+
+    def __call__(self, image, mask=None):
+        # image: HxWxC uint8, mask: HxW bool or uint8 (InfoMatch only), both resized to the exported size
+        height, width = image.shape[:2]
+        x = np.asarray(Image.fromarray(image).resize(self.size[::-1], Image.BILINEAR), 'float32')
+        x = (x.reshape(self.image['shape']) - 127.5) / 127.5
+        self.interpreter.set_tensor(self.image['index'], x)
+        if self.mask is not None:
+            # without a mask the whole image is the target region
+            mask = np.ones((height, width), 'uint8') if mask is None else mask
+            # binarised with > 0 like training masks, so anti-aliased edges do not reach the graph as soft values
+            m = Image.fromarray((np.asarray(mask) > 0).astype('uint8'))
+            m = (np.asarray(m.resize(self.size[::-1], Image.NEAREST)) > 0).astype('float32')
+            self.interpreter.set_tensor(self.mask['index'], m.reshape(self.mask['shape']))
+        self.interpreter.invoke()
+
+        y = self.interpreter.get_tensor(self.output['index'])[0]
+        y = np.clip(y * 127.5 + 127.5, 0, 255).astype('uint8')
+        return np.asarray(Image.fromarray(y.squeeze()).resize((width, height), Image.BILINEAR))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help='.tflite file written by export.py')
+    parser.add_argument('--input', type=str, required=True)
+    parser.add_argument('--mask', type=str, default='', help='target mask, InfoMatch only, the whole image when omitted')
+    parser.add_argument('--output', type=str, default='translated.jpg')
+    parser.add_argument('--num_threads', type=int, default=None)
+    opt = parser.parse_args()
+
+    translator = Translator(opt.model_path, opt.num_threads)
+    image = np.asarray(Image.open(opt.input).convert('RGB' if translator.image['shape'][-1] == 3 else 'L'))
+    mask = np.asarray(Image.open(opt.mask).convert('L')) if opt.mask else None
+    Image.fromarray(translator(image, mask)).save(opt.output)
+
+
+if __name__ == '__main__':
+    main()
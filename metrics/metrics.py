@@ -5,6 +5,8 @@ import pandas as pd
 import numpy as np
 from scipy.linalg import sqrtm
 from scipy.stats import entropy
+from models.modules import normalize_images
+from models.quantize import quantize_model
 
 
 def calculate_fid(Eb, Eab):
@@ -27,13 +29,18 @@ def calculate_fid(Eb, Eab):
 
 
 class MetricsCallbacks(callbacks.Callback):
-    def __init__(self, val_data, opt, params, train=False):
+    def __init__(self, val_data, opt, params, train=False, calibration=None):
         super().__init__()
         self.validation_data = val_data
         self.opt = opt
         self.params_ = params
         self.train=train
         self.inception_model = self.build_inception()
+        if calibration is not None:
+            # int8 inception calibrated on local images in [-1, 1]
+            images = [self.preprocess(x[None])[0].numpy() for x in calibration]
+            self.inception_model = quantize_model(self.inception_model, images, f'{opt.cache_dir}/int8',
+                                                  'inceptionv3')
 
     def on_train_begin(self, logs=None):
         self.IS = []
@@ -48,9 +55,13 @@ class MetricsCallbacks(callbacks.Callback):
         Eb = []
         Eab = []
         for xa, xb in self.validation_data:
+            xa, xb = normalize_images((xa, xb))
+            if self.opt.with_masks:
+                (xa, _), (xb, mb) = xa, xb
+
             # translation
             if self.opt.model =='InfoMatch':
-                xab_wrapped, grids = self.model.CP(xa)
+                xab_wrapped, grids = self.model.CP([xa, mb])
                 xab, _ = self.model.R(xab_wrapped)
 
             elif self.opt.model == 'CycleGAN' or self.opt.model == 'DCLGAN':
@@ -73,9 +84,9 @@ class MetricsCallbacks(callbacks.Callback):
             # get embeddings
             _, eb = self.inception_model(xb)
             pab, eab = self.inception_model(xab)
-            Eb.append(eb)
-            Eab.append(eab)
-            all_preds.append(pab)
+            Eb.append(tf.cast(eb, 'float32'))
+            Eab.append(tf.cast(eab, 'float32'))
+            all_preds.append(tf.cast(pab, 'float32'))
 
         # Inception Score
         IS = []
@@ -98,7 +109,7 @@ class MetricsCallbacks(callbacks.Callback):
         print(f'--fid: {FID} --is: {IS}')
 
     def preprocess(self, x):
-        x = x * 127.5 + 127.5
+        x = tf.cast(x, 'float32') * 127.5 + 127.5
         x = tf.image.resize(x, (299, 299))
         x = preprocess_input(x)
         return x
@@ -53,35 +53,23 @@ class PatchSampleMLP(tf.keras.Model):
         super(PatchSampleMLP, self).__init__(**kwargs)
         self.units = config['units']
         self.num_patches = config['num_patches']
-        self.l2_norm = layers.Lambda(lambda x: x * tf.math.rsqrt(tf.reduce_sum(tf.square(x), axis=-1, keepdims=True) + 1e-10))
 
     def build(self, input_shape):
-        initializer = tf.random_normal_initializer(0., 0.02)
-        feats_shape = input_shape
-        for feat_id in range(len(feats_shape)):
-            mlp = tf.keras.models.Sequential([
-                    layers.Dense(self.units, activation="relu", kernel_initializer=initializer),
-                    layers.Dense(self.units, kernel_initializer=initializer),
-                ])
-            setattr(self, f'mlp_{feat_id}', mlp)
+        self.head = ProjectionHead(self.units, [shape[-1] for shape in input_shape])
 
     def call(self, inputs, patch_ids=None, training=None):
         feats = inputs
         samples = []
         ids = []
         for feat_id, feat in enumerate(feats):
-            B, H, W, C = feat.shape
-            feat_reshape = tf.reshape(feat, [B, -1, C])
+            _, H, W, _ = shape_list(feat)
             if patch_ids is not None:
                 patch_id = patch_ids[feat_id]
             else:
-                patch_id = tf.random.shuffle(tf.range(H * W))[:min(self.num_patches, H * W)]
-            x_sample = tf.reshape(tf.gather(feat_reshape, patch_id, axis=1), [-1, C])
-            mlp = getattr(self, f'mlp_{feat_id}')
-            x_sample = mlp(x_sample)
-            x_sample = self.l2_norm(x_sample)
-            samples.append(x_sample)
+                patch_id = sample_patch_coords(H, W, self.num_patches)
+            samples.append(gather_patches(feat, patch_id))
             ids.append(patch_id)
+        samples = [tf.reshape(x, [-1, self.units]) for x in self.head(samples)]
         return samples, ids
 
   
@@ -97,6 +85,7 @@ class CUT(tf.keras.Model):
     self.use_identity = config['use_identity']
     self.lambda_nce = config['lambda_nce']
     self.tau = config['tau']
+    self.nce_chunk_size = config['nce_chunk_size']
     
   def compile(self,
               G_optimizer,
@@ -106,19 +95,19 @@ class CUT(tf.keras.Model):
       self.G_optimizer = G_optimizer
       self.F_optimizer = F_optimizer
       self.D_optimizer = D_optimizer
-      self.nce_loss_func = PatchNCELoss(self.tau)
+      self.nce_loss_func = PatchNCELoss(self.tau, self.nce_chunk_size)
   
-  @tf.function
+  @relaxed_step
   def train_step(self, inputs):
-    source, target = inputs
+    source, target = normalize_images(inputs)
     x = tf.concat([source, target], axis=0) if self.use_identity else source
     
     with tf.GradientTape(persistent=True) as tape:
       y = self.G(x, training=True)
-      x2y = y[:source.shape[0]]
+      x2y = y[:tf.shape(source)[0]]
       
       if self.use_identity:
-        y_idt = y[source.shape[0]:]
+        y_idt = y[tf.shape(source)[0]:]
       
       critic_fake = self.D(x2y, training=True)
       critic_real = self.D(target, training=True)
@@ -146,16 +135,16 @@ class CUT(tf.keras.Model):
     
     return {'g_loss': g_loss_, 'd_loss':d_loss, 'nce': nce_loss}
   
-  @tf.function
+  @relaxed_step
   def test_step(self, inputs):
-    source, target = inputs
+    source, target = normalize_images(inputs)
     x = tf.concat([source, target], axis=0) if self.use_identity else source
     
     y = self.G(x, training=True)
-    x2y = y[:source.shape[0]]
+    x2y = y[:tf.shape(source)[0]]
       
     if self.use_identity:
-      y_idt = y[source.shape[0]:]
+      y_idt = y[tf.shape(source)[0]:]
 
     ###compute loss
     nce_loss = self.nce_loss_func(source, x2y, self.E, self.F)
@@ -65,9 +65,9 @@ class CycleGAN(tf.keras.Model):
         self.Db_optimizer = Db_optimizer
 
 
-    @tf.function
+    @relaxed_step
     def train_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
 
         with tf.GradientTape(persistent=True) as tape:
             xba = self.Ga(xb)
@@ -105,9 +105,9 @@ class CycleGAN(tf.keras.Model):
         self.Db_optimizer.apply_gradients(zip(Dbgrads, self.Db.trainable_weights))
         return {'l_cycle': l_cycle, 'g_loss': l_ga + l_gb, 'd_loss': l_da + l_db}
 
-    @tf.function
+    @relaxed_step
     def test_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
         xba = self.Ga(xb)
         xab = self.Gb(xa)
         # cyclic
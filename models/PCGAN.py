@@ -2,15 +2,16 @@ import sys
 sys.path.append('./models')
 from modules import *
 from losses import *
+from warping import *
+from vgg import truncated_vgg
 from discriminators import Discriminator
 import tensorflow as tf
 from tensorflow.keras import layers
-from tensorflow.keras.applications.vgg19 import VGG19, preprocess_input
 
 
 class Generator(tf.keras.Model):
     def __init__(self, config, refinement):
-        super().__init__()
+        super().__init__(autocast=False)  # warping and the residual blend stay in float32
         self.refinement = refinement
         self.act = config['act']
         self.use_bias = config['use_bias']
@@ -44,157 +45,66 @@ class Generator(tf.keras.Model):
 
         if refinement:
             self.alpha = tf.Variable(0., trainable=True)
+        else:
+            # coarse-to-fine mode: the displacement is predicted at 1/flow_scale resolution and upsampled,
+            # optionally corrected by a small full resolution head
+            self.flow_scale = config['flow_scale']
+            self.flow_head = tf.keras.Sequential([
+                Padding2D(1, pad_type='reflect'),
+                ConvBlock(config['base'] // 2, 3, padding='valid', use_bias=self.use_bias, activation=self.act),
+                Padding2D(1, pad_type='reflect'),
+                ConvBlock(2, 3, padding='valid', activation='tanh'),
+            ]) if config['flow_refine'] else None
 
     def call(self, x):
         if not self.refinement:
-            grids_shift = self.blocks(x)
-            grids_shift = grids_shift / 10.
-            grids = affine_grid_generator(x.shape[1], x.shape[2], x.shape[0]) + \
+            grids_shift = self.predict_flow(x)
+            grids = affine_grid_generator(*shape_list(x)[1:3]) + \
                     tf.transpose(grids_shift, perm=[0, 3, 1, 2])
             x_wrapped = bilinear_sampler(x, grids) #wrapping b's shape to a's
             return x_wrapped, grids
         else:
-            residual = self.blocks(x)
+            residual = tf.cast(self.blocks(x), 'float32')
             residual = residual * self.alpha
             x = tf.clip_by_value(residual + x, -1., 1.)
             return x, residual
 
+    def predict_flow(self, x):
+        if self.flow_scale == 1:
+            return tf.cast(self.blocks(x), 'float32') / 10.
+        size = tf.shape(x)[1:3]
+        coarse = tf.image.resize(x, size // self.flow_scale, method='area')
+        grids_shift = tf.image.resize(tf.cast(self.blocks(coarse), 'float32') / 10., size, method='bilinear')
+        if self.flow_head is not None:
+            grids_shift = grids_shift + tf.cast(self.flow_head(tf.concat([x, grids_shift], axis=-1)), 'float32') / 10.
+        return grids_shift
+
 
 class PatchSampler(tf.keras.Model):
     def __init__(self, config, **kwargs):
         super().__init__(**kwargs)
         self.units = config['units']
         self.num_patches = config['num_patches']
-        self.l2_norm = layers.Lambda(
-            lambda x: x * tf.math.rsqrt(tf.reduce_sum(tf.square(x), axis=-1, keepdims=True) + 1e-10))
 
     def build(self, input_shape):
-        initializer = tf.random_normal_initializer(0., 0.02)
-        feats_shape = input_shape
-        for feat_id in range(len(feats_shape)):
-            mlp = tf.keras.models.Sequential([
-                layers.Dense(self.units, activation="relu", kernel_initializer=initializer),
-                layers.Dense(self.units, kernel_initializer=initializer),
-            ])
-            setattr(self, f'mlp_{feat_id}', mlp)
+        self.head = ProjectionHead(self.units, [shape[-1] for shape in input_shape])
 
     def call(self, inputs, patch_ids=None, training=None):
         feats = inputs
         samples = []
         ids = []
         for feat_id, feat in enumerate(feats):
-            B, H, W, C = feat.shape
-            feat_reshape = tf.reshape(feat, [B, -1, C])
+            _, H, W, _ = shape_list(feat)
             if patch_ids is not None:
                 patch_id = patch_ids[feat_id]
             else:
-                patch_id = tf.random.shuffle(tf.range(H * W))[:min(self.num_patches, H * W)]
-            x_sample = tf.reshape(tf.gather(feat_reshape, patch_id, axis=1), [-1, C])
-            mlp = getattr(self, f'mlp_{feat_id}')
-            x_sample = mlp(x_sample)
-            x_sample = self.l2_norm(x_sample)
-            samples.append(x_sample)
+                patch_id = sample_patch_coords(H, W, self.num_patches)
+            samples.append(gather_patches(feat, patch_id))
             ids.append(patch_id)
+        samples = [tf.reshape(x, [-1, self.units]) for x in self.head(samples)]
         return samples, ids
 
 
-def affine_grid_generator(height, width, num_batch):
-    theta = tf.concat([tf.repeat(tf.eye(2)[None, ...], num_batch, axis=0),
-                       tf.zeros((num_batch, 2, 1))], axis=-1)
-    # create normalized 2D grid
-    x = tf.linspace(-1.0, 1.0, width)
-    y = tf.linspace(-1.0, 1.0, height)
-    x_t, y_t = tf.meshgrid(x, y)
-    # flatten
-    x_t_flat = tf.reshape(x_t, [-1])
-    y_t_flat = tf.reshape(y_t, [-1])
-    # reshape to [x_t, y_t , 1] - (homogeneous form)
-    ones = tf.ones_like(x_t_flat)
-    sampling_grid = tf.stack([x_t_flat, y_t_flat, ones])
-    # repeat grid num_batch times
-    sampling_grid = tf.expand_dims(sampling_grid, axis=0)
-    sampling_grid = tf.tile(sampling_grid, tf.stack([num_batch, 1, 1]))
-
-    # cast to float32 (required for matmul)
-    theta = tf.cast(theta, 'float32')
-    sampling_grid = tf.cast(sampling_grid, 'float32')
-
-    # transform the sampling grid - batch multiply
-    batch_grids = tf.matmul(theta, sampling_grid)
-    # batch grid has shape (num_batch, 2, H*W)
-    # reshape to (num_batch, H, W, 2)
-    batch_grids = tf.reshape(batch_grids, [num_batch, 2, height, width])
-    return batch_grids
-
-
-def get_pixel_value(img, x, y):
-    shape = tf.shape(x)
-    batch_size = shape[0]
-    height = shape[1]
-    width = shape[2]
-    batch_idx = tf.range(0, batch_size)
-    batch_idx = tf.reshape(batch_idx, (batch_size, 1, 1))
-    b = tf.tile(batch_idx, (1, height, width))
-    indices = tf.stack([b, y, x], 3)
-    return tf.gather_nd(img, indices)
-
-
-def bilinear_sampler(img, grids):
-    x, y = grids[:, 0, ...], grids[:, 1, ...]
-    H = tf.shape(img)[1]
-    W = tf.shape(img)[2]
-    max_y = tf.cast(H - 1, 'int32')
-    max_x = tf.cast(W - 1, 'int32')
-    zero = tf.zeros([], dtype='int32')
-
-    # rescale x and y to [0, W-1/H-1]
-    x = tf.cast(x, 'float32')
-    y = tf.cast(y, 'float32')
-    x = 0.5 * ((x + 1.0) * tf.cast(max_x - 1, 'float32'))
-    y = 0.5 * ((y + 1.0) * tf.cast(max_y - 1, 'float32'))
-
-    # grab 4 nearest corner points for each (x_i, y_i)
-    x0 = tf.cast(tf.floor(x), 'int32')
-    x1 = x0 + 1
-    y0 = tf.cast(tf.floor(y), 'int32')
-    y1 = y0 + 1
-
-    # clip to range [0, H-1/W-1] to not violate img boundaries
-    x0 = tf.clip_by_value(x0, zero, max_x)
-    x1 = tf.clip_by_value(x1, zero, max_x)
-    y0 = tf.clip_by_value(y0, zero, max_y)
-    y1 = tf.clip_by_value(y1, zero, max_y)
-
-    # get pixel value at corner coords
-    Ia = get_pixel_value(img, x0, y0)
-    Ib = get_pixel_value(img, x0, y1)
-    Ic = get_pixel_value(img, x1, y0)
-    Id = get_pixel_value(img, x1, y1)
-
-    # recast as float for delta calculation
-    x0 = tf.cast(x0, 'float32')
-    x1 = tf.cast(x1, 'float32')
-    y0 = tf.cast(y0, 'float32')
-    y1 = tf.cast(y1, 'float32')
-
-    # calculate deltas
-    wa = (x1 - x) * (y1 - y)
-    wb = (x1 - x) * (y - y0)
-    wc = (x - x0) * (y1 - y)
-    wd = (x - x0) * (y - y0)
-
-    # add dimension for addition
-    wa = tf.expand_dims(wa, axis=3)
-    wb = tf.expand_dims(wb, axis=3)
-    wc = tf.expand_dims(wc, axis=3)
-    wd = tf.expand_dims(wd, axis=3)
-
-    # compute output
-    out = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
-
-    return out
-
-
 def ContentEncoder(model, config):
     nce_layers = config['nce_layers']
     outputs = []
@@ -213,10 +123,7 @@ class PerceptualEncoder(tf.keras.Model):
         return self.vgg(x)
 
     def build_vgg(self):
-        vgg = VGG19(include_top=False)
-        vgg.trainable = False
-        outputs = [vgg.layers[idx].output for idx in self.nce_layers]
-        return tf.keras.Model(inputs=vgg.input, outputs=outputs)
+        return truncated_vgg('vgg19', self.nce_layers)
 
 
 class PCGAN(tf.keras.Model):
@@ -241,16 +148,16 @@ class PCGAN(tf.keras.Model):
         self.D_optimizer = D_optimizer
 
         if self.config['loss_type'] == 'infonce':
-            self.loss_func = PatchNCELoss(self.config['tau'])
+            self.loss_func = PatchNCELoss(self.config['tau'], self.config['nce_chunk_size'])
         elif self.config['loss_type'] == 'perceptual_distance':
             self.loss_func = perceptual_loss
         elif self.config['loss_type'] == 'pixel_distance':
             self.loss_func = l1_loss
 
-    @tf.function
+    @relaxed_step
     def train_step(self, inputs):
         return {}
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
 
         with tf.GradientTape(persistent=True) as tape:
             ###Forward
@@ -279,16 +186,19 @@ class PCGAN(tf.keras.Model):
             else:
                 d_loss, g_loss = gan_loss(critic_real, critic_fake, self.config['gan_mode'])
 
-            # perceptual loss
+            # perceptual loss, with one encoder pass over all the images of the pairs
+            trl = (xab_wrapped, xab)
             if self.config['loss_type'] == 'infonce':
-                l_info_trl = self.loss_func(xab_wrapped, xab, self.E, self.F)
-                l_info_idt = self.loss_func(xb_idt_wrapped, xb_idt, self.E, self.F) \
-                    if self.config['use_identity'] else 0.
+                if self.config['use_identity']:
+                    l_info_trl, l_info_idt = self.loss_func.pairwise([trl, (xb_idt_wrapped, xb_idt)], self.E, self.F)
+                else:
+                    l_info_trl, l_info_idt = self.loss_func.pairwise([trl], self.E, self.F)[0], 0.
 
             elif self.config['loss_type'] == 'perceptual_distance':
-                l_info_trl = self.loss_func(xab_wrapped, xab, self.E)
-                l_info_idt = self.loss_func(xb_idt_wrapped, xb_idt, self.E) \
-                    if self.config['use_identity'] else 0.
+                if self.config['use_identity']:
+                    l_info_trl, l_info_idt = perceptual_losses([trl, (xb_idt_wrapped, xb_idt)], self.E)
+                else:
+                    l_info_trl, l_info_idt = perceptual_losses([trl], self.E)[0], 0.
 
             elif self.config['loss_type'] == 'pixel_distance':
                 l_info_trl = self.loss_func(xab_wrapped, xab)
@@ -312,9 +222,9 @@ class PCGAN(tf.keras.Model):
         return {'info_trl': l_info_trl, 'info_idt': l_info_idt,
                 'g_loss': g_loss, 'd_loss': d_loss}
 
-    @tf.function
+    @relaxed_step
     def test_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
         ###Forward
         # translation
         xab_wrapped, _ = self.CP(xa)  # wrap b's shape to a
@@ -324,15 +234,16 @@ class PCGAN(tf.keras.Model):
         xb_idt_wrapped, _ = self.CP(xb)
         xb_idt, _ = self.CP(xb_idt_wrapped)
 
-        # perceptual loss
+        # perceptual loss, with one encoder pass over all the images of the pairs
+        trl = (xab_wrapped, xab)
         if self.config['loss_type'] == 'infonce':
-            l_info_trl = self.loss_func(xab_wrapped, xab, self.E, self.F)
-            l_info_idt = self.loss_func(xb_idt_wrapped, xb_idt, self.E, self.F)
+            l_info_trl, l_info_idt = self.loss_func.pairwise([trl, (xb_idt_wrapped, xb_idt)], self.E, self.F)
 
         elif self.config['loss_type'] == 'perceptual_distance':
-            l_info_trl = self.loss_func(xab_wrapped, xab, self.E)
-            l_info_idt = self.loss_func(xb_idt_wrapped, xb_idt, self.E) \
-                if self.config['use_identity'] else 0.
+            if self.config['use_identity']:
+                l_info_trl, l_info_idt = perceptual_losses([trl, (xb_idt_wrapped, xb_idt)], self.E)
+            else:
+                l_info_trl, l_info_idt = perceptual_losses([trl], self.E)[0], 0.
 
         elif self.config['loss_type'] == 'pixel_distance':
             l_info_trl = self.loss_func(xab_wrapped, xab)
@@ -128,9 +128,9 @@ class UGATIT(tf.keras.Model):
         self.Da_optimizer = Da_optimizer
         self.Db_optimizer = Db_optimizer
 
-    @tf.function
+    @relaxed_step
     def train_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
 
         with tf.GradientTape(persistent=True) as tape:
             ###forward
@@ -161,20 +161,20 @@ class UGATIT(tf.keras.Model):
             l_cycle = l1_loss(xa, xaba) + l1_loss(xb, xbab)
 
             # cam generator
-            l_ga_cam = bc(tf.ones_like(cam_logits_ba), cam_logits_ba) + \
-                       bc(tf.zeros_like(cam_logits_aa), cam_logits_aa)
+            l_ga_cam = bce_loss(tf.ones_like(cam_logits_ba), cam_logits_ba) + \
+                       bce_loss(tf.zeros_like(cam_logits_aa), cam_logits_aa)
 
-            l_gb_cam = bc(tf.ones_like(cam_logits_ab), cam_logits_ab) + \
-                       bc(tf.zeros_like(cam_logits_bb), cam_logits_bb)
+            l_gb_cam = bce_loss(tf.ones_like(cam_logits_ab), cam_logits_ab) + \
+                       bce_loss(tf.zeros_like(cam_logits_bb), cam_logits_bb)
 
             # cam discriminator
-            l_da_cam = bc(tf.ones_like(critic_real_cam_logits_a), critic_real_cam_logits_a) + \
-                       bc(tf.zeros_like(critic_fake_cam_logits_a), critic_fake_cam_logits_a)
-            l_db_cam = bc(tf.ones_like(critic_real_cam_logits_b), critic_real_cam_logits_b) + \
-                       bc(tf.zeros_like(critic_fake_cam_logits_b), critic_fake_cam_logits_b)
+            l_da_cam = bce_loss(tf.ones_like(critic_real_cam_logits_a), critic_real_cam_logits_a) + \
+                       bce_loss(tf.zeros_like(critic_fake_cam_logits_a), critic_fake_cam_logits_a)
+            l_db_cam = bce_loss(tf.ones_like(critic_real_cam_logits_b), critic_real_cam_logits_b) + \
+                       bce_loss(tf.zeros_like(critic_fake_cam_logits_b), critic_fake_cam_logits_b)
 
-            l_dga_cam = bc(tf.ones_like(critic_fake_cam_logits_a), critic_fake_cam_logits_a)
-            l_dgb_cam = bc(tf.ones_like(critic_fake_cam_logits_b), critic_fake_cam_logits_b)
+            l_dga_cam = bce_loss(tf.ones_like(critic_fake_cam_logits_a), critic_fake_cam_logits_a)
+            l_dgb_cam = bce_loss(tf.ones_like(critic_fake_cam_logits_b), critic_fake_cam_logits_b)
 
             # adversarial loss
             da_loss, ga_loss = gan_loss(critic_real_a, critic_fake_a, self.config['gan_mode'])
@@ -201,8 +201,9 @@ class UGATIT(tf.keras.Model):
                 'g_loss': 0.5 * (ga_loss + gb_loss), 'd_loss': 0.5 * (da_loss + db_loss)
                 }
 
+    @relaxed_step
     def test_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
         ###forward
         # identity
         xaa, cam_logits_aa = self.Ga(xa)
@@ -225,10 +226,10 @@ class UGATIT(tf.keras.Model):
         l_cycle = l1_loss(xa, xaba) + l1_loss(xb, xbab)
 
         # cam generator
-        l_ga_cam = bc(tf.ones_like(cam_logits_ba), cam_logits_ba) + \
-                   bc(tf.zeros_like(cam_logits_aa), cam_logits_aa)
+        l_ga_cam = bce_loss(tf.ones_like(cam_logits_ba), cam_logits_ba) + \
+                   bce_loss(tf.zeros_like(cam_logits_aa), cam_logits_aa)
 
-        l_gb_cam = bc(tf.ones_like(cam_logits_ab), cam_logits_ab) + \
-                   bc(tf.zeros_like(cam_logits_bb), cam_logits_bb)
+        l_gb_cam = bce_loss(tf.ones_like(cam_logits_ab), cam_logits_ab) + \
+                   bce_loss(tf.zeros_like(cam_logits_bb), cam_logits_bb)
 
         return {'l_r': 0.5 * (l_ra + l_rb), 'l_cycle': l_cycle, 'l_g_cam': 0.5 * (l_ga_cam + l_gb_cam)}
@@ -76,7 +76,7 @@ class Generator(tf.keras.Model):
 
     def encode(self, x):
         h = self.E(x)
-        z = tf.random.normal(h.shape)
+        z = tf.random.normal(tf.shape(h), dtype=h.dtype)
         return h, z
 
     def decode(self, x):
@@ -105,13 +105,13 @@ class UNIT(tf.keras.Model):
         self.Da_optimizer = Da_optimizer
         self.Db_optimizer = Db_optimizer
 
-    @tf.function
+    @relaxed_step
     def train_step(self, inputs):
-        xa, xb = inputs
+        xa, xb = normalize_images(inputs)
 
         with tf.GradientTape(persistent=True) as tape:
-            za = tf.random.normal((xa.shape[0], 1, 1, self.style_dim))
-            zb = tf.random.normal((xb.shape[0], 1, 1, self.style_dim))
+            za = tf.random.normal((tf.shape(xa)[0], 1, 1, self.style_dim), dtype=self.compute_dtype)
+            zb = tf.random.normal((tf.shape(xb)[0], 1, 1, self.style_dim), dtype=self.compute_dtype)
 
             ### forward
             # encode
@@ -186,11 +186,11 @@ class UNIT(tf.keras.Model):
                 'l_h': 0.5 * (l_ha + l_hb), 'l_cycle': l_cycle,
                 'g_loss': 0.5 * (g_loss_a + g_loss_b), 'd_loss': 0.5 * (d_loss_a + d_loss_b)}
 
-    @tf.function
+    @relaxed_step
     def test_step(self, inputs):
-        xa, xb = inputs
-        za = tf.random.normal((xa.shape[0], 1, 1, self.style_dim))
-        zb = tf.random.normal((xb.shape[0], 1, 1, self.style_dim))
+        xa, xb = normalize_images(inputs)
+        za = tf.random.normal((tf.shape(xa)[0], 1, 1, self.style_dim), dtype=self.compute_dtype)
+        zb = tf.random.normal((tf.shape(xb)[0], 1, 1, self.style_dim), dtype=self.compute_dtype)
 
         ### forward
         # encode
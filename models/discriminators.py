@@ -25,7 +25,7 @@ class Discriminator(tf.keras.Model):
             outputs = []
             for disc in self.disc:
                 outputs.append(disc(x))
-                x = tf.image.resize(x, [x.shape[1]//2, x.shape[2]//2])
+                x = tf.image.resize(x, tf.shape(x)[1:3] // 2)
         else:
             outputs = self.disc(x)
         return outputs
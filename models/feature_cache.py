@@ -0,0 +1,61 @@
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+
+class FeatureStore:
+    # a fixed number of slots per encoder layer in fp16 memory-mapped files, for one input resolution
+    def __init__(self, directory, shapes, capacity):
+        os.makedirs(directory, exist_ok=True)
+        self.layers = [np.memmap(f'{directory}/layer{i}.bin', dtype='float16', mode='w+', shape=(capacity,) + shape)
+                       for i, shape in enumerate(shapes)]
+        self.capacity = capacity
+        self.slots = OrderedDict()  # image key -> slot, least recently used first
+
+    def slot(self, key):
+        if key in self.slots:
+            self.slots.move_to_end(key)
+            return self.slots[key]
+        if len(self.slots) < self.capacity:
+            slot = len(self.slots)
+        else:
+            _, slot = self.slots.popitem(last=False)
+        self.slots[key] = slot
+        return slot
+
+
+class FeatureCache:
+    """ Encoder features of real images, keyed by a fingerprint of the image content so that a key covers both
+    the source file and the crop/flip it went through. Every resolution gets its own store within max_mb.
+    The key index lives in memory, so the files are private to the process and removed with the cache.
+    """
+
+    def __init__(self, directory, num_layers, max_mb):
+        os.makedirs(directory, exist_ok=True)
+        self.tmp = tempfile.TemporaryDirectory(dir=directory, prefix='run_')
+        self.directory = self.tmp.name
+        self.num_layers = num_layers
+        self.max_bytes = max_mb * 2 ** 20
+        self.stores = {}
+
+    def lookup(self, keys, size):
+        store = self.stores.get(tuple(size))
+        keys = [k.tobytes() for k in keys]
+        if store is None or not all(k in store.slots for k in keys):
+            return [np.bool_(False)] + [np.zeros(0, 'float16')] * self.num_layers
+        slots = [store.slot(k) for k in keys]
+        return [np.bool_(True)] + [np.asarray(layer[slots]) for layer in store.layers]
+
+    def store(self, keys, size, *feats):
+        size = tuple(size)
+        if size not in self.stores:
+            shapes = [f.shape[1:] for f in feats]
+            capacity = max(len(keys), self.max_bytes // (2 * sum(int(np.prod(s)) for s in shapes)))
+            self.stores[size] = FeatureStore(f'{self.directory}/{size[0]}x{size[1]}', shapes, capacity)
+        store = self.stores[size]
+        for i, key in enumerate(keys):
+            slot = store.slot(key.tobytes())
+            for layer, feat in zip(store.layers, feats):
+                layer[slot] = feat[i]
+        return np.bool_(True)
@@ -5,26 +5,64 @@ bc = losses.BinaryCrossentropy(from_logits=True)
 
 
 def l_kl(h):
-    return tf.reduce_mean(h ** 2)
+    return tf.reduce_mean(tf.cast(h, 'float32') ** 2)
 
 def l1_loss(x, y):
-    return tf.reduce_mean(tf.abs(x - y))
+    return tf.reduce_mean(tf.abs(tf.cast(x, 'float32') - tf.cast(y, 'float32')))
 
 
 def l2_loss(x, y):
-    return tf.reduce_mean((x - y) ** 2)
+    return tf.reduce_mean((tf.cast(x, 'float32') - tf.cast(y, 'float32')) ** 2)
+
+
+def ssim_score(x, y):
+    return tf.reduce_mean(tf.image.ssim(tf.cast(x, 'float32'), tf.cast(y, 'float32'), max_val=2.))
+
+
+def encode_batch(netE, images, real=()):
+    # one encoder pass over the distinct images (the same tensor passed twice is encoded once),
+    # features are split back per image in the order given. real images go through the encoder's
+    # feature cache or int8 model when it has one
+    if getattr(netE, 'cache', None) is None and getattr(netE, 'quantized', None) is None:
+        real = ()
+    unique, cached = [], []
+    for x in images:
+        group = cached if any(x is r for r in real) else unique
+        if not any(x is u for u in group):
+            group.append(x)
+
+    feats = {}
+    for group, encode in [(unique, lambda x: netE(x, training=True)), (cached, lambda x: netE.encode_real(x))]:
+        if group:
+            # generator outputs may be in the compute dtype, real images are float32
+            split = [tf.split(f, len(group), axis=0)
+                     for f in encode(tf.concat([tf.cast(x, 'float32') for x in group], axis=0))]
+            for i, x in enumerate(group):
+                feats[id(x)] = [f[i] for f in split]
+    return [feats[id(x)] for x in images]
+
+
+def perceptual_losses(pairs, netE, real=()):
+    feats = encode_batch(netE, [x for pair in pairs for x in pair], real)
+    losses = []
+    for feat_source, feat_target in zip(feats[::2], feats[1::2]):
+        total_per_loss = 0.
+        for feat_s, feat_t in zip(feat_source, feat_target):
+            total_per_loss += l1_loss(feat_s, feat_t)
+        losses.append(total_per_loss)
+    return losses
 
 
 def perceptual_loss(source, target, netE):
-    feat_source = netE(source, training=True)
-    feat_target = netE(target, training=True)
-    total_per_loss = 0.
-    for feat_s, feat_t in zip(feat_source, feat_target):
-        total_per_loss += l1_loss(feat_s, feat_t)
-    return total_per_loss
+    return perceptual_losses([(source, target)], netE)[0]
+
+
+def bce_loss(target, logits):
+    return bc(tf.cast(target, 'float32'), tf.cast(logits, 'float32'))
 
 
 def gan_loss(critic_real, critic_fake, gan_mode):
+    critic_real, critic_fake = tf.cast(critic_real, 'float32'), tf.cast(critic_fake, 'float32')
     if gan_mode == 'lsgan':
         d_loss = tf.reduce_mean((1 - critic_real) ** 2 + critic_fake ** 2)
         g_loss = tf.reduce_mean((1 - critic_fake) ** 2)
@@ -43,43 +81,105 @@ def gan_loss(critic_real, critic_fake, gan_mode):
     return 0.5 * d_loss, g_loss
 
 
+def chunked_logsumexp(feat_s, feat_t, tau, chunk_size):
+    # logsumexp over q of <feat_s[b, p], feat_t[b, q]> / tau, streamed over chunks of chunk_size target patches
+    # with a running max, so the [B, P, P] logits are never materialised. the backward pass recomputes each
+    # chunk from the saved logsumexp instead of keeping the softmax around
+    n_patches = tf.shape(feat_t)[1]
+    num_chunks = (n_patches + chunk_size - 1) // chunk_size
+
+    def chunk_logits(feat_s, feat_t, i):
+        feat_c = feat_t[:, i * chunk_size:(i + 1) * chunk_size]
+        return feat_c, tf.einsum('bpd,bqd->bpq', feat_s, feat_c) / tau
+
+    @tf.custom_gradient
+    def logsumexp(feat_s, feat_t):
+        def body(i, running_max, running_sum):
+            _, logit = chunk_logits(feat_s, feat_t, i)
+            new_max = tf.maximum(running_max, tf.reduce_max(logit, axis=-1))
+            running_sum = running_sum * tf.exp(running_max - new_max) + \
+                          tf.reduce_sum(tf.exp(logit - new_max[..., None]), axis=-1)
+            return i + 1, new_max, running_sum
+
+        init_max = tf.fill(tf.shape(feat_s)[:2], float('-inf'))
+        _, running_max, running_sum = tf.while_loop(
+            lambda i, *_: i < num_chunks, body, [0, init_max, tf.zeros_like(init_max)],
+            parallel_iterations=1)
+        lse = running_max + tf.math.log(running_sum)
+
+        def grad(upstream):
+            def body(i, grad_s, grad_t):
+                feat_c, logit = chunk_logits(feat_s, feat_t, i)
+                weight = upstream[..., None] * tf.exp(logit - lse[..., None]) / tau
+                grad_s += tf.einsum('bpq,bqd->bpd', weight, feat_c)
+                grad_t = grad_t.write(i, tf.transpose(tf.einsum('bpq,bpd->bqd', weight, feat_s), [1, 0, 2]))
+                return i + 1, grad_s, grad_t
+
+            grad_t = tf.TensorArray(feat_t.dtype, size=num_chunks, infer_shape=False)
+            _, grad_s, grad_t = tf.while_loop(
+                lambda i, *_: i < num_chunks, body, [0, tf.zeros_like(feat_s), grad_t],
+                parallel_iterations=1)
+            return grad_s, tf.transpose(grad_t.concat(), [1, 0, 2])
+
+        return lse, grad
+
+    return logsumexp(feat_s, feat_t)
+
+
+def patch_nce_loss(feats_source, feats_target, sample_ids, tau, chunk_size=0):
+    # per-image InfoNCE: samples are viewed as [B, P, D], each patch is scored against the patches of its own
+    # image only and the positive sits on the diagonal, so the labels are just range(P). layers drawing the same
+    # number of patches are stacked along the batch axis and share a single batched matmul
+    groups = {}
+    for feat_s, feat_t, patch_id in zip(feats_source, feats_target, sample_ids):
+        key = (patch_id.shape[0], feat_s.shape[-1])
+        if key[0] is None:
+            key = id(patch_id)
+        groups.setdefault(key, []).append((feat_s, feat_t, tf.shape(patch_id)[0]))
+
+    total_nce_loss = 0.0
+    for group in groups.values():
+        n_patches = group[0][2]
+        feat_s = tf.concat([tf.reshape(s, [-1, n_patches, s.shape[-1]]) for s, _, _ in group], axis=0)
+        feat_t = tf.concat([tf.reshape(t, [-1, n_patches, t.shape[-1]]) for _, t, _ in group], axis=0)
+        feat_s, feat_t = tf.cast(feat_s, 'float32'), tf.cast(feat_t, 'float32')
+
+        if chunk_size:
+            # cross entropy with the diagonal as target is logsumexp minus the positive logit
+            positive = tf.reduce_sum(feat_s * feat_t, axis=-1) / tau
+            loss = chunked_logsumexp(feat_s, feat_t, tau, chunk_size) - positive
+        else:
+            logit = tf.einsum('bpd,bqd->bpq', feat_s, feat_t) / tau
+            labels = tf.broadcast_to(tf.range(n_patches), tf.shape(logit)[:2])
+            loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels, logit)
+        # every layer of a group contributes B * P terms, so the group mean times its size is the sum of layer means
+        total_nce_loss += tf.reduce_mean(loss) * len(group)
+
+    return total_nce_loss / len(feats_source)
+
+
 class PatchNCELoss:
-    def __init__(self, tau):
-        # Potential: only supports for batch_size=1 now.
+    def __init__(self, tau, chunk_size=0):
         self.tau = tau
-        self.cross_entropy_loss = tf.keras.losses.CategoricalCrossentropy(
-            reduction=tf.keras.losses.Reduction.NONE,
-            from_logits=True)
+        self.chunk_size = chunk_size
 
     def __call__(self, source, target, netE, netF):
-        feat_source = netE(source, training=True)
-        feat_target = netE(target, training=True)
-
-        feat_source_pool, sample_ids = netF(feat_source, patch_ids=None, training=True)
-        feat_target_pool, _ = netF(feat_target, patch_ids=sample_ids, training=True)
-
-        total_nce_loss = 0.0
-        for feat_s, feat_t in zip(feat_source_pool, feat_target_pool):
-            n_patches, dim = feat_s.shape
-
-            logit = tf.matmul(feat_s, tf.transpose(feat_t)) / self.tau
-            # Diagonal entries are pos logits, the others are neg logits.
-            diagonal = tf.eye(n_patches, dtype=tf.bool)
-            target = tf.where(diagonal, 1.0, 0.0)
-
-            loss = self.cross_entropy_loss(target, logit)
-            total_nce_loss += tf.reduce_mean(loss)
-
-        return total_nce_loss / len(feat_source_pool)
+        return self.pairwise([(source, target)], netE, netF)[0]
 
+    def pairwise(self, pairs, netE, netF, real=()):
+        feats = encode_batch(netE, [x for pair in pairs for x in pair], real)
+        losses = []
+        for feat_source, feat_target in zip(feats[::2], feats[1::2]):
+            feat_source_pool, sample_ids = netF(feat_source, patch_ids=None, training=True)
+            feat_target_pool, _ = netF(feat_target, patch_ids=sample_ids, training=True)
+            losses.append(patch_nce_loss(feat_source_pool, feat_target_pool, sample_ids, self.tau, self.chunk_size))
+        return losses
 
 
 class PatchNCELoss_Dual:
-    def __init__(self, tau):
+    def __init__(self, tau, chunk_size=0):
         self.tau = tau
-        self.cross_entropy_loss = tf.keras.losses.CategoricalCrossentropy(
-            reduction=tf.keras.losses.Reduction.NONE,
-            from_logits=True)
+        self.chunk_size = chunk_size
 
     def __call__(self, source, target, netEx, netEy, netF, domain=['x', 'y']):
         feat_source = netEx(source, training=True)
@@ -88,16 +188,4 @@ class PatchNCELoss_Dual:
         feat_source_pool, sample_ids = netF(feat_source, patch_ids=None, training=True, domain=domain[0])
         feat_target_pool, _ = netF(feat_target, patch_ids=sample_ids, training=True, domain=domain[1])
 
-        total_nce_loss = 0.0
-        for feat_s, feat_t in zip(feat_source_pool, feat_target_pool):
-            n_patches, dim = feat_s.shape
-
-            logit = tf.matmul(feat_s, tf.transpose(feat_t)) / self.tau
-            # Diagonal entries are pos logits, the others are neg logits.
-            diagonal = tf.eye(n_patches, dtype=tf.bool)
-            target = tf.where(diagonal, 1.0, 0.0)
-
-            loss = self.cross_entropy_loss(target, logit)
-            total_nce_loss += tf.reduce_mean(loss)
-
-        return total_nce_loss / len(feat_source_pool)
+        return patch_nce_loss(feat_source_pool, feat_target_pool, sample_ids, self.tau, self.chunk_size)
@@ -1,5 +1,78 @@
 from tensorflow.keras import layers
 import tensorflow as tf
+import numpy as np
+
+PATCH_STRATA = {}
+
+
+def normalize_images(inputs):
+    # uint8 batches from the input pipeline are scaled to [-1, 1] inside the step, bool masks become {0, 1}
+    # and float batches pass through
+    def normalize(x):
+        if x.dtype == tf.uint8:
+            return (tf.cast(x, 'float32') - 127.5) / 127.5
+        if x.dtype == tf.bool:
+            return tf.cast(x, 'float32')
+        return x
+    return tf.nest.map_structure(normalize, inputs)
+
+
+def shape_list(x):
+    # static dims where they are known, dynamic ones otherwise, so traced steps accept any batch size
+    dynamic = tf.shape(x)
+    return [dynamic[i] if dim is None else dim for i, dim in enumerate(x.shape.as_list())]
+
+
+def relaxed_step(step):
+    # tf.function for train_step/test_step with an input_signature of the first batch's structure and dtypes,
+    # batch dimension left open, so the validation, preview and partial batches reuse the same graph
+    name = f'_{step.__name__}_function'
+
+    def wrapper(self, inputs):
+        function = getattr(self, name, None)
+        if function is None:
+            signature = tf.nest.map_structure(lambda x: tf.TensorSpec([None] + x.shape[1:].as_list(), x.dtype),
+                                              inputs)
+            function = tf.function(lambda x: step(self, x), input_signature=[signature])
+            setattr(self, name, function)
+        return function(inputs)
+    return wrapper
+
+
+def patch_count(height, width, num_patches):
+    # at most one patch per position, in python on static maps and in the graph on dynamic ones
+    if isinstance(height * width, int):
+        return min(num_patches, height * width)
+    return tf.minimum(num_patches, height * width)
+
+
+def patch_strata(height, width, num_patches):
+    # start and size of num_patches contiguous strata covering the height * width positions in raster order,
+    # tabulated once per resolution
+    if isinstance(height, int) and isinstance(width, int):
+        key = (height, width, num_patches)
+        if key not in PATCH_STRATA:
+            bounds = np.arange(num_patches + 1) * (height * width) // num_patches
+            PATCH_STRATA[key] = (bounds[:-1].astype('int32'), np.diff(bounds).astype('int32'))
+        return [tf.constant(t) for t in PATCH_STRATA[key]]
+
+    bounds = tf.range(num_patches + 1) * (height * width) // num_patches
+    return bounds[:-1], bounds[1:] - bounds[:-1]
+
+
+def sample_patch_coords(height, width, num_patches):
+    # one position drawn uniformly inside each stratum: distinct positions spread over the map in O(num_patches),
+    # returned as [P, 2] (y, x) coordinates
+    start, size = patch_strata(height, width, patch_count(height, width, num_patches))
+    offset = tf.cast(tf.random.uniform(tf.shape(size)) * tf.cast(size, 'float32'), 'int32')
+    ids = start + tf.minimum(offset, size - 1)
+    return tf.stack([ids // width, ids % width], axis=-1)
+
+
+def gather_patches(feat, coords):
+    # [B, H, W, C] feature map to [B, P, C] samples at the same coordinates for every image
+    coords = tf.broadcast_to(coords, tf.concat([tf.shape(feat)[:1], tf.shape(coords)], axis=0))
+    return tf.gather_nd(feat, coords, batch_dims=1)
 
 
 class Padding2D(layers.Layer):
@@ -41,39 +114,59 @@ class InstanceNorm(layers.Layer):
                                         trainable=True)
 
     def call(self, inputs, training=None):
-        mean, var = tf.nn.moments(inputs, axes=[1, 2], keepdims=True)
-        x = tf.divide(tf.subtract(inputs, mean), tf.math.sqrt(tf.add(var, self.epsilon)))
+        # one pass over the input for E[x] and E[x^2], statistics in float32 whatever the compute dtype,
+        # then a single scale and shift
+        x = tf.cast(inputs, 'float32')
+        mean = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+        var = tf.maximum(tf.reduce_mean(tf.square(x), axis=[1, 2], keepdims=True) - tf.square(mean), 0.)
+        scale = tf.math.rsqrt(var + self.epsilon)
         if self.affine:
-            return self.gamma * x + self.beta
-        return x
+            scale = scale * tf.cast(self.gamma, 'float32')
+            return tf.cast(x * scale + (tf.cast(self.beta, 'float32') - mean * scale), inputs.dtype)
+        return tf.cast(x * scale - mean * scale, inputs.dtype)
 
 
 class LayerInstanceNorm(layers.Layer):
     def __init__(self, adaptive=False):
         super().__init__()
-        self.inst = InstanceNorm(affine=False)
         self.ln = layers.LayerNormalization()
 
         self.rho = tf.Variable(tf.constant(1.0),
                                constraint=lambda x: tf.clip_by_value(x, 0.0, 1.0))
 
         self.adaptive = adaptive
+        self.epsilon = 1e-5
 
     def build(self, shape):
         if self.adaptive:
             dim = shape[0][-1]
             self.gamma = layers.Dense(dim)
             self.beta = layers.Dense(dim)
+            shape = shape[0]
+        # the layer norm is only kept for its gamma and beta, the statistics are computed below
+        self.ln.build(shape)
 
     def call(self, inputs):
         if self.adaptive:
             x, w = inputs
         else:
             x = inputs
-        x_in = self.inst (x)
-        x_ln = self.ln(x)
+        dtype = x.dtype
+
+        # instance (spatial) and layer (channel) statistics share one read of x and x^2
+        x = tf.cast(x, 'float32')
+        x_sq = tf.square(x)
+        mean_in = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+        var_in = tf.maximum(tf.reduce_mean(x_sq, axis=[1, 2], keepdims=True) - tf.square(mean_in), 0.)
+        mean_ln = tf.reduce_mean(x, axis=-1, keepdims=True)
+        var_ln = tf.maximum(tf.reduce_mean(x_sq, axis=-1, keepdims=True) - tf.square(mean_ln), 0.)
+
         rho = tf.clip_by_value(self.rho - 0.1, 0.0, 1.0)
-        x = rho * x_in + (1 - rho) * x_ln
+        scale_in = rho * tf.math.rsqrt(var_in + self.epsilon)
+        scale_ln = (1 - rho) * tf.math.rsqrt(var_ln + self.ln.epsilon)
+        gamma, beta = tf.cast(self.ln.gamma, 'float32'), tf.cast(self.ln.beta, 'float32')
+        x = x * (scale_in + scale_ln * gamma) - mean_in * scale_in - mean_ln * scale_ln * gamma + (1 - rho) * beta
+        x = tf.cast(x, dtype)
         if self.adaptive:
             x = self.gamma(w) * x + self.beta(w)
         return x
@@ -220,3 +313,47 @@ class ResBlock(layers.Layer):
             x = self.reflect_pad2(x)
             x = self.conv_block2(x)
         return x + skip
+
+
+class ProjectionHead(layers.Layer):
+    """ Two layer MLP per feature layer with the weights of all layers stacked, so that each stage is one batched
+    matmul, followed by the L2 normalisation. Narrower layers are zero-padded to the widest input, rows of the
+    first-stage kernels past a layer's width only ever meet zeros and get no gradient.
+    """
+
+    def __init__(self, units, channels, **kwargs):
+        super(ProjectionHead, self).__init__(**kwargs)
+        self.units = units
+        self.channels = list(channels)
+
+        initializer = tf.random_normal_initializer(0., 0.02)
+        n = len(self.channels)
+        self.kernels = [self.add_weight(name=f'kernel_{i}', shape=(n, d, units), initializer=initializer,
+                                        trainable=True)
+                        for i, d in enumerate([max(self.channels), units])]
+        self.biases = [self.add_weight(name=f'bias_{i}', shape=(n, units), initializer=tf.zeros_initializer(),
+                                       trainable=True)
+                       for i in range(2)]
+
+    def call(self, inputs, training=None):
+        # inputs are [B, P, C] patch samples, one per feature layer. patch counts are padded to the largest one
+        # as well and sliced back after the projection
+        counts = [shape_list(x)[1] for x in inputs]
+        num = max(counts) if all(isinstance(c, int) for c in counts) else tf.reduce_max(tf.stack(counts))
+        width = max(self.channels)
+        x = tf.stack([tf.pad(s, [[0, 0], [0, num - count], [0, width - dim]])
+                      for s, count, dim in zip(inputs, counts, self.channels)])
+        x = tf.nn.relu(tf.matmul(x, self.kernels[0][:, None]) + self.biases[0][:, None, None])
+        x = tf.cast(tf.matmul(x, self.kernels[1][:, None]) + self.biases[1][:, None, None], 'float32')
+        x = x * tf.math.rsqrt(tf.reduce_sum(tf.square(x), axis=-1, keepdims=True) + 1e-10)
+        return [s[:, :count] for s, count in zip(tf.unstack(x), counts)]
+
+    def assign_legacy(self, weights):
+        # weights maps a feature layer to the [kernel, bias, kernel, bias] of its former mlp_{feat_id} Sequential
+        for feat_id, dim in enumerate(self.channels):
+            if feat_id not in weights:
+                continue
+            self.kernels[0][feat_id].assign(tf.pad(weights[feat_id][0], [[0, max(self.channels) - dim], [0, 0]]))
+            self.biases[0][feat_id].assign(weights[feat_id][1])
+            self.kernels[1][feat_id].assign(weights[feat_id][2])
+            self.biases[1][feat_id].assign(weights[feat_id][3])
@@ -0,0 +1,54 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+
+def calibration_key(model, images):
+    # the flatbuffer depends on the architecture, the input size and the calibration images
+    # keras numbers model and input names per session, so only the layer types and settings are hashed
+    layers = [(type(layer).__name__, {k: v for k, v in layer.get_config().items() if k != 'name'})
+              for layer in model.layers]
+    digest = hashlib.sha1(json.dumps([layers, model.output_names], sort_keys=True, default=str).encode())
+    for image in images:
+        image = np.ascontiguousarray(image, 'float32')
+        digest.update(str(image.shape).encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def quantize_model(model, images, directory, name):
+    # full integer post-training quantization with float input and output, calibrated on images in the
+    # model's input range. the flatbuffer is written once under directory and reused while its key matches
+    path = f'{directory}/{name}_{calibration_key(model, images)}.tflite'
+    if not os.path.exists(path):
+        def representative_dataset():
+            for image in images:
+                yield [np.asarray(image, 'float32')[None]]
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(converter.convert())
+    return QuantizedModel(path, model)
+
+
+class QuantizedModel:
+    """ Int8 TFLite interpreter called like the frozen keras model it was converted from, on numpy arrays or
+    eager tensors. Outputs are returned in the keras order.
+    """
+
+    def __init__(self, path, model):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=os.cpu_count())
+        # the signature keeps the keras input and output names, the runner resizes the input to each batch
+        self.runner = self.interpreter.get_signature_runner()
+        self.input = next(iter(self.runner.get_input_details()))
+        self.output_names = model.output_names
+
+    def __call__(self, x):
+        outputs = self.runner(**{self.input: np.asarray(x, 'float32')})
+        return [outputs[name] for name in self.output_names]
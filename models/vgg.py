@@ -0,0 +1,48 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+
+WEIGHTS_PATH = 'https://storage.googleapis.com/tensorflow/keras-applications/{0}/{0}_weights_tf_dim_ordering_tf_kernels_notop.h5'
+VGG_BLOCKS = {'vgg16': [2, 2, 3, 3, 3], 'vgg19': [2, 2, 4, 4, 4]}
+VGG_FILTERS = [64, 128, 256, 512, 512]
+
+
+def vgg_layers(arch):
+    # (name, filters) in the order of keras' VGG16/VGG19 layers, index 0 being the input and pools having no filters
+    names = [('input', None)]
+    for block, (num_convs, filters) in enumerate(zip(VGG_BLOCKS[arch], VGG_FILTERS), 1):
+        names += [(f'block{block}_conv{i}', filters) for i in range(1, num_convs + 1)]
+        names.append((f'block{block}_pool', None))
+    return names
+
+
+def vgg_flops(arch, depth, height=256, width=256):
+    # multiply-adds of the convolutions up to layer depth, counted as 2 flops each
+    flops, channels = 0, 3
+    for name, filters in vgg_layers(arch)[1:depth + 1]:
+        if filters is None:
+            height, width = height // 2, width // 2
+        else:
+            flops += 2 * height * width * 9 * channels * filters
+            channels = filters
+    return flops
+
+
+def truncated_vgg(arch, layer_ids):
+    # keras' imagenet VGG rebuilt only up to the deepest requested layer, the weights of the kept layers are
+    # loaded by name from the notop file
+    depth = max(layer_ids)
+    x = inputs = layers.Input((None, None, 3))
+    outputs = [inputs]
+    for name, filters in vgg_layers(arch)[1:depth + 1]:
+        if filters is None:
+            x = layers.MaxPooling2D((2, 2), strides=(2, 2), name=name)(x)
+        else:
+            x = layers.Conv2D(filters, (3, 3), activation='relu', padding='same', name=name)(x)
+        outputs.append(x)
+    model = tf.keras.Model(inputs=inputs, outputs=[outputs[idx] for idx in layer_ids])
+
+    weights = tf.keras.utils.get_file(f'{arch}_weights_tf_dim_ordering_tf_kernels_notop.h5',
+                                      WEIGHTS_PATH.format(arch), cache_subdir='models')
+    model.load_weights(weights, by_name=True)
+    model.trainable = False
+    return model
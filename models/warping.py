@@ -0,0 +1,88 @@
+import numpy as np
+import tensorflow as tf
+
+IDENTITY_GRIDS = {}
+
+
+def identity_grid(height, width):
+    # normalised [x, y] sampling grid of shape (1, 2, height, width), built once per resolution
+    if isinstance(height, int) and isinstance(width, int):
+        if (height, width) not in IDENTITY_GRIDS:
+            x_t, y_t = np.meshgrid(np.linspace(-1., 1., width), np.linspace(-1., 1., height))
+            IDENTITY_GRIDS[(height, width)] = np.stack([x_t, y_t])[None].astype('float32')
+        return tf.constant(IDENTITY_GRIDS[(height, width)])
+
+    # sizes only known at run time are generated in the graph, still without tiling over the batch
+    x_t, y_t = tf.meshgrid(tf.linspace(-1.0, 1.0, width), tf.linspace(-1.0, 1.0, height))
+    return tf.stack([x_t, y_t])[None]
+
+
+def affine_grid_generator(height, width, theta=None):
+    grid = identity_grid(height, width)
+    if theta is None:
+        # broadcasts over the batch when the predicted shift is added
+        return grid
+
+    # theta has shape (num_batch, 2, 3), applied to the homogeneous grid [x_t, y_t, 1]
+    theta = tf.cast(theta, 'float32')
+    return tf.einsum('bij,jhw->bihw', theta[:, :, :2], grid[0]) + theta[:, :, 2, None, None]
+
+
+def sampling_coords(grids, height, width):
+    # rescale x and y to [0, W-1/H-1]
+    max_y = height - 1
+    max_x = width - 1
+    x = 0.5 * ((tf.cast(grids[:, 0], 'float32') + 1.0) * tf.cast(max_x - 1, 'float32'))
+    y = 0.5 * ((tf.cast(grids[:, 1], 'float32') + 1.0) * tf.cast(max_y - 1, 'float32'))
+
+    # 4 nearest corner points, clipped to the image
+    x0 = tf.cast(tf.floor(x), 'int32')
+    y0 = tf.cast(tf.floor(y), 'int32')
+    x1 = tf.clip_by_value(x0 + 1, 0, max_x)
+    y1 = tf.clip_by_value(y0 + 1, 0, max_y)
+    x0 = tf.clip_by_value(x0, 0, max_x)
+    y0 = tf.clip_by_value(y0, 0, max_y)
+
+    # flat row indices into the (B*H*W, C) image for the corners a=(x0,y0), b=(x0,y1), c=(x1,y0), d=(x1,y1)
+    base = tf.reshape(tf.range(tf.shape(grids)[0]) * height * width, [-1, 1, 1])
+    indices = tf.stack([base + y0 * width + x0, base + y1 * width + x0,
+                        base + y0 * width + x1, base + y1 * width + x1], axis=-1)
+
+    deltas = (x - tf.cast(x0, 'float32'), tf.cast(x1, 'float32') - x,
+              y - tf.cast(y0, 'float32'), tf.cast(y1, 'float32') - y)
+    dx0, dx1, dy0, dy1 = deltas
+    weights = tf.stack([dx1 * dy1, dx1 * dy0, dx0 * dy1, dx0 * dy0], axis=-1)
+    return indices, weights, deltas
+
+
+def bilinear_sampler(img, grids):
+    # all 4 corners come from a single gather, and the backward pass recomputes the indices
+    # and weights from img and grids instead of keeping the corner tensors alive
+    shape = tf.shape(img)
+    height, width = shape[1], shape[2]
+    channels = img.shape[-1] if img.shape[-1] is not None else shape[3]
+
+    @tf.custom_gradient
+    def sample(img, grids):
+        flat = tf.reshape(img, [-1, channels])
+        indices, weights, _ = sampling_coords(grids, height, width)
+        out = tf.reduce_sum(tf.gather(flat, indices) * weights[..., None], axis=3)
+
+        def grad(upstream):
+            indices, weights, (dx0, dx1, dy0, dy1) = sampling_coords(grids, height, width)
+
+            # image: scatter the upstream gradient onto the 4 corners
+            d_img = tf.math.unsorted_segment_sum(
+                tf.reshape(upstream[..., None, :] * weights[..., None], [-1, channels]),
+                tf.reshape(indices, [-1]), tf.shape(flat)[0])
+
+            # grid: derivative of the bilinear weights w.r.t. x and y
+            ga, gb, gc, gd = tf.unstack(tf.reduce_sum(tf.gather(flat, indices) * upstream[..., None, :], axis=-1),
+                                        axis=-1)
+            d_x = (dy1 * (gc - ga) + dy0 * (gd - gb)) * 0.5 * tf.cast(width - 2, 'float32')
+            d_y = (dx1 * (gb - ga) + dx0 * (gd - gc)) * 0.5 * tf.cast(height - 2, 'float32')
+            return tf.reshape(d_img, shape), tf.cast(tf.stack([d_x, d_y], axis=1), grids.dtype)
+
+        return out, grad
+
+    return sample(img, grids)
@@ -15,19 +15,69 @@ def parse_opt():
     parser.add_argument('--batch_size', type=int, default=3)
     parser.add_argument('--image_size', type=int, default=256)
     parser.add_argument('--num_channels', type=int, default=3)
+    parser.add_argument('--crop_size', type=int, default=128, help='random crop size for training')
+    parser.add_argument('--fused_crop', action='store_true',
+                        help='decode only the random crop window of each training jpeg')
     parser.add_argument('--val_size', type=int, default=0.1)
     parser.add_argument('--lr', type=float, default=1e-4, help='learning rate')
     parser.add_argument('--beta_1', type=float, default=0.5, help='momentum of adam')
     parser.add_argument('--beta_2', type=float, default=0.999, help='momentum of adam')
     parser.add_argument('--num_samples', type=int, default=3)
+    parser.add_argument('--data_backend', type=str, default='jpeg', choices=['jpeg', 'tfrecord', 'mmap'],
+                        help='tfrecord: decode and resize once into uint8 shards under cache_dir, '
+                             'mmap: pack each domain into one memory-mapped uint8 array under cache_dir')
+    parser.add_argument('--cache_dir', type=str, default='./cache')
+    parser.add_argument('--shard_size', type=int, default=256, help='images per cache shard')
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='crop, flip and jitter whole training batches after batching')
+    parser.add_argument('--scale_jitter', type=float, default=0., help='max relative crop upscale with --batch_augment')
+    parser.add_argument('--color_jitter', type=float, default=0., help='brightness/contrast jitter with --batch_augment')
+    parser.add_argument('--uint8_pipeline', action='store_true',
+                        help='keep images uint8 in the input pipeline and normalise inside the train/test step')
+    parser.add_argument('--unpaired', action='store_true',
+                        help='sample both domains independently instead of truncating to the smaller one')
+    parser.add_argument('--steps_per_epoch', type=int, default=0,
+                        help='batches per epoch with --unpaired, 0 means one pass over the larger domain')
+    parser.add_argument('--seed', type=int, default=999, help='seed of the unpaired sampler')
+    parser.add_argument('--save_freq', type=int, default=0,
+                        help='checkpoint every n batches, 0 means every epoch')
+    parser.add_argument('--num_workers', type=int, default=32, help='threads used to scan image directories')
+    parser.add_argument('--val_cache_mb', type=int, default=1024,
+                        help='memory budget for the decoded validation set, larger sets are cached on disk')
+    parser.add_argument('--feature_cache_mb', type=int, default=0,
+                        help='memory-mapped fp16 cache of perceptual features of validation images under cache_dir, '
+                             '0 disables')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                        help='bfloat16 computes in bfloat16 with float32 weights, norms and losses')
+    parser.add_argument('--int8_encoders', action='store_true',
+                        help='int8 post-training quantized VGG for real-image features in validation and InceptionV3 '
+                             'for metrics, the training loss keeps the float VGG')
+    parser.add_argument('--calib_size', type=int, default=256, help='local images used to calibrate --int8_encoders')
+    parser.add_argument('--with_masks', action='store_true', help='pair every image with a mask, implied by InfoMatch')
+    parser.add_argument('--source_mask_dir', type=str, default='', help="defaults to '<source_dir>_masks'")
+    parser.add_argument('--target_mask_dir', type=str, default='', help="defaults to '<target_dir>_masks'")
     opt, _ = parser.parse_known_args()
+    opt.with_masks = opt.with_masks or opt.model == 'InfoMatch'
+    opt.start_step = 0  # batches consumed before a restart, set by load_data_state
+    if opt.with_masks and opt.data_backend == 'tfrecord':
+        # records are read sequentially and can not be joined with the mask store by index
+        parser.error(f'--data_backend {opt.data_backend} can not serve masks (--with_masks, implied by InfoMatch), '
+                     'use jpeg or mmap')
     return opt
   
   
 def main():
   opt = parse_opt()
+  if opt.precision == 'bfloat16':
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
   model, params = load_model(opt)
-  
+  calibration = calibration_images(opt) if opt.int8_encoders else None
+  if opt.int8_encoders:
+    quantize_encoders(model, opt, calibration)
+
+  ckpt_dir = f"{opt.ckpt_dir}/{opt.model}/{params}"
+  load_data_state(opt, params)
+
   ds_train, ds_val = build_dataset(opt)
   model.compile(
       optimizers.Adam(learning_rate=opt.lr, beta_1=opt.beta_1, beta_2=opt.beta_2),
@@ -36,31 +86,36 @@ def main():
       optimizers.Adam(learning_rate=opt.lr, beta_1=opt.beta_1, beta_2=opt.beta_2)
   )
 
-  ckpt_dir = f"{opt.ckpt_dir}/{opt.model}/{params}"
   if os.path.exists(ckpt_dir):
-    model.load_weights(tf.train.latest_checkpoint(ckpt_dir)).expect_partial()
+    ckpt = tf.train.latest_checkpoint(ckpt_dir)
+    model.load_weights(ckpt).expect_partial()
+    load_legacy_projection(model, ckpt)
+    if not opt.unpaired:
+      # only the unpaired streams save their position, the paired epochs are reshuffled from the start
+      print(f'--resuming {ckpt} without --unpaired: the data pipeline restarts at a new epoch')
 
   source, target = [], []
   if opt.source_test_dir =='':
       for s, t in ds_val.take(opt.num_samples):
           source.append(s)
           target.append(t)
-      source = tf.concat(source, axis=0)
-      target = tf.concat(target, axis=0)
-      callbacks = set_callbacks(opt, params, source, target, val_ds=ds_val)
+      source = normalize_images(tf.nest.map_structure(lambda *x: tf.concat(x, axis=0), *source))
+      target = normalize_images(tf.nest.map_structure(lambda *x: tf.concat(x, axis=0), *target))
+      callbacks = set_callbacks(opt, params, source, target, val_ds=ds_val, calibration=calibration)
   else:
       ds = build_dataset(opt, True)
       for s, t in ds.take(opt.num_samples):
           source.append(s)
           target.append(t)
-      source = tf.concat(source, axis=0)
-      target = tf.concat(target, axis=0)
-      callbacks = set_callbacks(opt, params, source, target, val_ds=ds)
+      source = normalize_images(tf.nest.map_structure(lambda *x: tf.concat(x, axis=0), *source))
+      target = normalize_images(tf.nest.map_structure(lambda *x: tf.concat(x, axis=0), *target))
+      callbacks = set_callbacks(opt, params, source, target, val_ds=ds, calibration=calibration)
 
   model.fit(
       x=ds_train,
       validation_data=ds_val,
       epochs=opt.num_epochs,
+      steps_per_epoch=opt.steps_per_epoch if opt.unpaired else None,
       callbacks=callbacks
   )
   
@@ -1,7 +1,16 @@
 import os
+import re
+import glob
+import shutil
+import tempfile
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from sklearn.model_selection import train_test_split as ttp
-from models import CUT, PCGAN, CycleGAN, UNIT, UGATIT, DCLGAN
+from models import CUT, PCGAN, CPCGAN, CycleGAN, UNIT, UGATIT, DCLGAN
+from models.modules import normalize_images
+from models.quantize import quantize_model
 from tensorflow.keras import callbacks
 import matplotlib.pyplot as plt
 import yaml
@@ -13,15 +22,23 @@ AUTOTUNE = tf.data.experimental.AUTOTUNE
 def load_model(opt):
     config = get_config(f'./configs/{opt.model}.yaml')
     if opt.model == 'CUT':
-        model = CUT.CUT(config, opt)
+        model = CUT.CUT(config)
         params = f"{config['tau']}_{config['lambda_nce']}_{config['use_identity']}"
 
     elif opt.model == 'PCGAN':
-        model = InfoMatch.InfoMatch(config, opt)
+        model = PCGAN.PCGAN(config, opt)
         params = f"{config['loss_type']}_{config['tau']}_{config['use_identity']}"
+        if config['flow_scale'] != 1:
+            params += f"_flow{config['flow_scale']}{'r' if config['flow_refine'] else ''}"
+
+    elif opt.model == 'InfoMatch':
+        model = CPCGAN.InfoMatch(config, opt)
+        params = f"{config['loss_type']}_{config['tau']}_{config['use_identity']}"
+        if config['flow_scale'] != 1:
+            params += f"_flow{config['flow_scale']}{'r' if config['flow_refine'] else ''}"
 
     elif opt.model == 'CycleGAN':
-        model = CycleGAN.CycleGAN(config, opt)
+        model = CycleGAN.CycleGAN(config)
         params='_'
 
     elif opt.model == 'UNIT':
@@ -42,54 +59,579 @@ def get_config(config):
     with open(config, 'r') as stream:
         return yaml.load(stream, Loader=yaml.FullLoader)
 
-def augmentation(x):
-    x = tf.image.random_crop(x, [128, 128, 3])
+def augmentation(x, opt):
+    x = tf.image.random_crop(x, [opt.crop_size, opt.crop_size, x.shape[-1]])
     x = tf.image.random_flip_left_right(x)
     return x
 
-def get_image(pth, opt, train=False):
+def load_size(opt, train=False):
+    # training images keep a margin for the random crop
+    return opt.image_size + 15 if train else opt.image_size
+
+
+def decode_image(pth, opt, size):
     image = tf.image.decode_jpeg(tf.io.read_file(pth), channels=opt.num_channels)
+    return tf.image.resize(image, (size, size))
 
-    if train:
-        image = tf.cast(tf.image.resize(image, (opt.image_size + 15, opt.image_size + 15)), 'float32')
-        image = augmentation(image)
-    else:
-        image = tf.cast(tf.image.resize(image, (opt.image_size, opt.image_size)), 'float32')
+
+def decode_uint8(pth, opt, size):
+    return tf.saturate_cast(tf.round(decode_image(pth, opt, size)), 'uint8')
+
+
+def batch_augmented(opt):
+    # masked datasets keep the per-image path so image and mask share one crop
+    return opt.batch_augment and not opt.with_masks
+
+
+def preprocess_image(image, opt, train=False):
+    augment = train and not batch_augmented(opt)
+    if opt.uint8_pipeline:
+        # batches stay uint8 and are normalised inside train_step/test_step
+        if image.dtype != tf.uint8:
+            image = tf.saturate_cast(tf.round(image), 'uint8')
+        return augmentation(image, opt) if augment else image
+    image = tf.cast(image, 'float32')
+    if augment:
+        image = augmentation(image, opt)
     return (image-127.5)/127.5
 
-def build_tf_dataset(source_list, target_list, opt, train = False):
-    ds_source = tf.data.Dataset.from_tensor_slices(source_list).map(lambda pth: get_image(pth, opt, train),
-                                                                    num_parallel_calls=AUTOTUNE).shuffle(256).prefetch(
-        AUTOTUNE)
-    ds_target = tf.data.Dataset.from_tensor_slices(target_list).map(lambda pth: get_image(pth, opt, train),
-                                                                    num_parallel_calls=AUTOTUNE).shuffle(256).prefetch(
-        AUTOTUNE)
-    ds = tf.data.Dataset.zip((ds_source, ds_target)).shuffle(256).batch(opt.batch_size if train
-                        else opt.num_samples, drop_remainder=True).prefetch(AUTOTUNE)
-    return ds
+
+def batch_augmentation(x, opt):
+    # crop, flip and scale jitter of the whole batch in a single crop_and_resize,
+    # boxes are drawn per sample and a box with x1 > x2 is sampled mirrored
+    b = tf.shape(x)[0]
+    size = tf.cast(tf.shape(x)[1], 'float32')
+    extent = tf.minimum(opt.crop_size * tf.random.uniform([b], 1., 1. + opt.scale_jitter), size)
+    y0 = tf.floor(tf.random.uniform([b]) * (size - extent + 1))
+    x0 = tf.floor(tf.random.uniform([b]) * (size - extent + 1))
+    y1 = y0 + extent - 1
+    x1 = x0 + extent - 1
+    flip = tf.random.uniform([b]) < 0.5
+    boxes = tf.stack([y0, tf.where(flip, x1, x0), y1, tf.where(flip, x0, x1)], axis=1) / (size - 1)
+    out = tf.image.crop_and_resize(x, boxes, tf.range(b), [opt.crop_size, opt.crop_size])
+
+    # images are either uint8 or already normalised to [-1, 1]
+    low, high, unit = (0., 255., 127.5) if x.dtype == tf.uint8 else (-1., 1., 1.)
+    if opt.color_jitter > 0:
+        contrast = tf.random.uniform([b, 1, 1, 1], 1. - opt.color_jitter, 1. + opt.color_jitter)
+        brightness = tf.random.uniform([b, 1, 1, 1], -opt.color_jitter, opt.color_jitter) * unit
+        mean = tf.reduce_mean(out, axis=[1, 2, 3], keepdims=True)
+        out = tf.clip_by_value((out - mean) * contrast + mean + brightness, low, high)
+
+    if x.dtype == tf.uint8:
+        return tf.saturate_cast(tf.round(out), 'uint8')
+    return out
+
+
+def decode_crop(pth, opt):
+    # the crop window is drawn in the resized frame and mapped back onto the jpeg,
+    # so only that region is decoded, at a 1/2, 1/4 or 1/8 DCT scale when the source allows it
+    contents = tf.io.read_file(pth)
+    shape = tf.image.extract_jpeg_shape(contents)[:2]
+    size = load_size(opt, True)
+
+    ratio_id = tf.reduce_sum(tf.cast(tf.reduce_min(shape) // [2, 4, 8] >= size, 'int32'))
+    ratio = tf.bitwise.left_shift(1, ratio_id)
+    scaled = (shape + ratio - 1) // ratio
+    scale = tf.cast(scaled, 'float32') / size
+
+    offset = tf.random.uniform([2], 0, size - opt.crop_size + 1, dtype='int32')
+    begin = tf.cast(tf.cast(offset, 'float32') * scale, 'int32')
+    extent = tf.maximum(tf.cast(tf.round(opt.crop_size * scale), 'int32'), 1)
+    window = tf.concat([begin, tf.minimum(extent, scaled - begin)], axis=0)
+
+    image = tf.switch_case(ratio_id, [
+        lambda r=r: tf.image.decode_and_crop_jpeg(contents, window, channels=opt.num_channels, ratio=r)
+        for r in (1, 2, 4, 8)])
+    image = tf.image.resize(image, (opt.crop_size, opt.crop_size))
+    return tf.image.random_flip_left_right(image)
+
+
+def get_image(pth, opt, train=False):
+    if train and opt.fused_crop and not batch_augmented(opt):
+        return preprocess_image(decode_crop(pth, opt), opt)  # already cropped and flipped
+    return preprocess_image(decode_image(pth, opt, load_size(opt, train)), opt, train)
+
+
+###Directory manifest
+def jpeg_complete(f):
+    # an EOI marker after the last start of scan. the tail is checked first, files with a longer trailer
+    # (camera metadata, embedded previews) are searched in full since 0xffd9 never occurs in entropy-coded data
+    f.seek(-64, 2)
+    if b'\xff\xd9' in f.read():
+        return True
+    f.seek(0)
+    data = f.read()
+    return data.find(b'\xff\xd9', max(data.rfind(b'\xff\xda'), 0)) != -1
+
+
+def jpeg_dimensions(pth):
+    # reads the frame header only, returns None for anything decode_jpeg would choke on
+    try:
+        with open(pth, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            if not jpeg_complete(f):
+                return None  # truncated
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                code = marker[1]
+                if code == 0x01 or 0xd0 <= code <= 0xd7:
+                    continue
+                length = int.from_bytes(f.read(2), 'big')
+                if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                    header = f.read(5)
+                    height, width = int.from_bytes(header[1:3], 'big'), int.from_bytes(header[3:5], 'big')
+                    return (height, width) if height > 0 and width > 0 else None
+                f.seek(length - 2, 1)
+    except OSError:
+        return None
+
+
+def manifest_path(directory, opt):
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+    return f'{opt.cache_dir}/manifests/{key}.json'
+
+
+def scan_directory(directory, opt):
+    pth = manifest_path(directory, opt)
+    manifest = {}
+    if os.path.exists(pth):
+        with open(pth, 'r') as f:
+            manifest = {entry['path']: entry for entry in json.load(f)}
+
+    with os.scandir(directory) as it:
+        files = sorted(f'{directory}/{e.name}' for e in it if e.is_file() and not e.name.startswith('.'))
+
+    # only new, modified or previously rejected files are opened, the rest is a stat against the previous manifest
+    def probe(file):
+        stat = os.stat(file)
+        entry = manifest.get(file)
+        if entry is None or not entry['valid'] or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            dims = jpeg_dimensions(file)
+            entry = {'path': file, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'height': dims[0] if dims else 0, 'width': dims[1] if dims else 0,
+                     'valid': dims is not None}
+        return entry
+
+    with ThreadPoolExecutor(opt.num_workers) as pool:
+        entries = list(pool.map(probe, files))
+
+    if len(entries) != len(manifest) or any(manifest.get(e['path']) is not e for e in entries):
+        os.makedirs(os.path.dirname(pth), exist_ok=True)
+        with open(f'{pth}.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(f'{pth}.tmp', pth)
+
+    return entries
+
+
+def list_images(directory, opt):
+    # valid images in name order, with the mtimes from the scan so cache keys need no second stat
+    entries = scan_directory(directory, opt)
+    valid = [entry for entry in entries if entry['valid']]
+    print(f'--{directory}: {len(valid)} images, {len(entries) - len(valid)} corrupt or non-JPEG files skipped')
+    return [entry['path'] for entry in valid], {entry['path']: entry['mtime'] for entry in valid}
+
+
+###Shard cache
+def cache_key(path_list, size, opt, mtimes):
+    # changes whenever a file is added, removed, touched, or the image size, channels or backend change.
+    # files missing from mtimes (masks) are stat'ed here
+    key = hashlib.sha1(f'{size}_{opt.num_channels}_{opt.data_backend}'.encode())
+    for pth in path_list:
+        mtime = mtimes[pth] if pth in mtimes else os.path.getmtime(pth)
+        key.update(f'{pth}:{mtime}'.encode())
+    return key.hexdigest()[:16]
+
+
+def store_slot(kind, path_list):
+    # the same kind of store over the same files, whatever their mtimes or the image size
+    return hashlib.sha1('\n'.join([kind] + list(path_list)).encode()).hexdigest()
+
+
+def publish_store(opt, key, slot, build):
+    # build fills a private temporary directory that is renamed to cache_dir/key once complete, so processes
+    # starting together never write into a store another one already maps. the first rename wins and the
+    # others drop their copy. older stores of the same slot are removed, mappings still open on them stay valid
+    store_dir = f'{opt.cache_dir}/{key}'
+    if os.path.exists(store_dir):
+        return store_dir
+
+    os.makedirs(opt.cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=opt.cache_dir, prefix=f'.{key}_')
+    try:
+        build(tmp)
+        with open(f'{tmp}/slot', 'w') as f:
+            f.write(slot)
+        os.rename(tmp, store_dir)
+    except OSError:
+        if not os.path.exists(store_dir):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    with os.scandir(opt.cache_dir) as it:
+        stores = [e.path for e in it if e.is_dir() and e.name != key and os.path.exists(f'{e.path}/slot')]
+    for pth in stores:
+        with open(f'{pth}/slot', 'r') as f:
+            stale = f.read() == slot
+        if stale:
+            shutil.rmtree(pth, ignore_errors=True)
+    return store_dir
+
+
+def build_shards(path_list, opt, size, mtimes):
+    def build(cache_dir):
+        ds = tf.data.Dataset.from_tensor_slices(path_list).map(lambda pth: decode_uint8(pth, opt, size),
+                                                              num_parallel_calls=AUTOTUNE)
+        shards = []
+        for shard_id, images in enumerate(ds.batch(opt.shard_size).prefetch(AUTOTUNE)):
+            shard = f'shard_{shard_id:05d}.tfrecord'
+            with tf.io.TFRecordWriter(f'{cache_dir}/{shard}') as writer:
+                for image in images.numpy():
+                    writer.write(image.tobytes())
+            shards.append(shard)
+
+        with open(f'{cache_dir}/index.json', 'w') as f:
+            json.dump({'shards': shards, 'size': size, 'num_images': len(path_list)}, f)
+
+    cache_dir = publish_store(opt, cache_key(path_list, size, opt, mtimes), store_slot('tfrecord', path_list), build)
+    with open(f'{cache_dir}/index.json', 'r') as f:
+        index = json.load(f)
+    return [f'{cache_dir}/{shard}' for shard in index['shards']]
+
+
+def parse_record(record, opt, size, train=False):
+    image = tf.reshape(tf.io.decode_raw(record, tf.uint8), (size, size, opt.num_channels))
+    return preprocess_image(image, opt, train)
+
+
+###Memory-mapped store
+def build_mmap_store(path_list, opt, size, mtimes):
+    def build(store_dir):
+        shape = (len(path_list), size, size, opt.num_channels)
+        store = np.lib.format.open_memmap(f'{store_dir}/images.npy', mode='w+', dtype=np.uint8, shape=shape)
+        ds = tf.data.Dataset.from_tensor_slices(path_list).map(lambda pth: decode_uint8(pth, opt, size),
+                                                              num_parallel_calls=AUTOTUNE)
+        offset = 0
+        for images in ds.batch(opt.shard_size).prefetch(AUTOTUNE):
+            store[offset:offset + len(images)] = images.numpy()
+            offset += len(images)
+        store.flush()
+        del store
+
+        # row i of the store holds paths[i]
+        with open(f'{store_dir}/mmap_index.json', 'w') as f:
+            json.dump({'paths': list(path_list), 'shape': shape}, f)
+
+    store_dir = publish_store(opt, cache_key(path_list, size, opt, mtimes), store_slot('mmap', path_list), build)
+    # read-only mapping, so every process on the host shares the same page cache
+    return np.load(f'{store_dir}/images.npy', mmap_mode='r')
+
+
+def read_row(store, i):
+    # a row is one contiguous slice of the file, read straight into the element without a gather
+    image = tf.numpy_function(lambda j: np.array(store[j]), [i], tf.uint8)
+    image.set_shape(store.shape[1:])
+    return image
+
+
+###Masks
+def pair_masks(path_list, mask_dir):
+    # a mask shares the image file name, with the same or a .png extension. missing masks are ''
+    names = set()
+    if os.path.isdir(mask_dir):
+        with os.scandir(mask_dir) as it:
+            names = {e.name for e in it}
+    pairs = []
+    for pth in path_list:
+        name = os.path.basename(pth)
+        png = f'{os.path.splitext(name)[0]}.png'
+        mask = f'{mask_dir}/{name}' if name in names else f'{mask_dir}/{png}' if png in names else ''
+        pairs.append((pth, mask))
+    return pairs
+
+
+def decode_mask(pth, size):
+    # an all-ones stand-in replaces missing masks
+    return tf.cond(tf.strings.length(pth) > 0,
+                   lambda: tf.image.resize(tf.io.decode_image(tf.io.read_file(pth), channels=1, expand_animations=False),
+                                           (size, size), method='nearest') > 0,
+                   lambda: tf.ones((size, size, 1), tf.bool))
+
+
+def build_mask_store(mask_list, opt, size):
+    # 1 bit per pixel, 24x smaller than the uint8 images they go with
+    def build(store_dir):
+        store = np.lib.format.open_memmap(f'{store_dir}/masks.npy', mode='w+', dtype=np.uint8,
+                                          shape=(len(mask_list), (size * size + 7) // 8))
+        ds = tf.data.Dataset.from_tensor_slices(mask_list).map(lambda pth: decode_mask(pth, size),
+                                                              num_parallel_calls=AUTOTUNE)
+        offset = 0
+        for masks in ds.batch(opt.shard_size).prefetch(AUTOTUNE):
+            masks = masks.numpy().reshape(len(masks), -1)
+            store[offset:offset + len(masks)] = np.packbits(masks, axis=-1)
+            offset += len(masks)
+        store.flush()
+        del store
+
+        with open(f'{store_dir}/mask_index.json', 'w') as f:
+            json.dump({'masks': list(mask_list), 'size': size}, f)
+
+    listing = hashlib.sha1('\n'.join(mask_list).encode()).hexdigest()[:8]
+    key = f"{cache_key([m for m in mask_list if m], size, opt, {})}_{listing}"
+    store_dir = publish_store(opt, key, store_slot(f'masks_{opt.data_backend}', mask_list), build)
+    return np.load(f'{store_dir}/masks.npy', mmap_mode='r')
+
+
+def read_mask(store, i, size):
+    # rows are unpacked lazily, one mask at a time
+    mask = tf.numpy_function(lambda j: np.unpackbits(store[j])[:size * size].reshape(size, size, 1).astype(bool),
+                             [i], tf.bool)
+    mask.set_shape((size, size, 1))
+    return mask
+
+
+def preprocess_pair(image, mask, opt, train=False):
+    # image and mask go through the same crop and flip as one tensor
+    if train:
+        x = augmentation(tf.concat([tf.cast(image, 'float32'), tf.cast(mask, 'float32')], axis=-1), opt)
+        image, mask = x[..., :-1], x[..., -1:] > 0.5
+    return preprocess_image(image, opt), mask
+
+
+def build_masked_domain_dataset(pair_list, opt, mtimes, train=False, unpaired=False, seed=0, start=0):
+    size = load_size(opt, train)
+    path_list, mask_list = [list(x) for x in zip(*pair_list)]
+    # masks are decoded once into the packed store whatever the image backend, tfrecord is rejected in parse_opt
+    mask_store = build_mask_store(mask_list, opt, size)
+    if opt.data_backend == 'mmap':
+        store = build_mmap_store(path_list, opt, size, mtimes)
+        read = lambda i: (read_row(store, i), read_mask(mask_store, i, size))
+    else:
+        paths = tf.constant(path_list)
+        read = lambda i: (decode_image(tf.gather(paths, i), opt, size), read_mask(mask_store, i, size))
+
+    ds = index_stream(len(path_list), unpaired, seed, start).map(
+        lambda i: preprocess_pair(*read(i), opt, train), num_parallel_calls=AUTOTUNE)
+    if train and not unpaired:
+        ds = ds.shuffle(256)
+    return ds.prefetch(AUTOTUNE)
+
+
+def index_stream(num, unpaired=False, seed=0, start=0):
+    if not unpaired:
+        return tf.data.Dataset.range(num)
+    # every pass is a full permutation instead of a bounded shuffle buffer, repeated forever.
+    # pass e is a stateless permutation of (seed, e), so the stream can be resumed at any position
+    ds = tf.data.Dataset.range(start // num, 2 ** 62).flat_map(
+        lambda epoch: tf.data.Dataset.from_tensor_slices(
+            tf.argsort(tf.random.stateless_uniform([num], seed=tf.stack([tf.constant(seed, 'int64'), epoch])))))
+    return ds.skip(start % num)
+
+
+def build_domain_dataset(path_list, opt, mtimes, train=False, unpaired=False, seed=0, start=0):
+    if opt.with_masks:
+        return build_masked_domain_dataset(path_list, opt, mtimes, train, unpaired, seed, start)
+    size = load_size(opt, train)
+    if opt.data_backend == 'tfrecord':
+        # records can not be indexed, resuming restarts at the shard holding the position
+        shards = tf.constant(build_shards(path_list, opt, size, mtimes))
+        ds = index_stream(len(shards), unpaired, seed, start // opt.shard_size).map(lambda i: tf.gather(shards, i))
+        ds = ds.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTOTUNE)
+        ds = ds.map(lambda record: parse_record(record, opt, size, train), num_parallel_calls=AUTOTUNE)
+        if unpaired:
+            ds = ds.shuffle(opt.shard_size, seed=seed)
+    elif opt.data_backend == 'mmap':
+        store = build_mmap_store(path_list, opt, size, mtimes)
+        ds = index_stream(len(store), unpaired, seed, start).map(
+            lambda i: preprocess_image(read_row(store, i), opt, train), num_parallel_calls=AUTOTUNE)
+    else:
+        paths = tf.constant(path_list)
+        ds = index_stream(len(path_list), unpaired, seed, start).map(
+            lambda i: get_image(tf.gather(paths, i), opt, train), num_parallel_calls=AUTOTUNE)
+    if train and not unpaired:
+        ds = ds.shuffle(256)
+    return ds.prefetch(AUTOTUNE)
+
+
+def build_tf_dataset(source_list, target_list, opt, mtimes, train = False):
+    ds_source = build_domain_dataset(source_list, opt, mtimes, train)
+    ds_target = build_domain_dataset(target_list, opt, mtimes, train)
+    ds = tf.data.Dataset.zip((ds_source, ds_target))
+    if not train:
+        return cache_eval_dataset(ds.batch(opt.num_samples, drop_remainder=True), source_list, target_list, opt,
+                                  mtimes)
+
+    ds = ds.shuffle(256).batch(opt.batch_size, drop_remainder=True)
+    if batch_augmented(opt):
+        ds = ds.map(lambda xa, xb: (batch_augmentation(xa, opt), batch_augmentation(xb, opt)),
+                    num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+def cache_eval_dataset(ds, source_list, target_list, opt, mtimes):
+    # decoded once and replayed in a fixed order by keras validation, the metrics callback and the
+    # preview batch. kept in memory within --val_cache_mb, spilled to a file under cache_dir otherwise
+    num_images = 2 * min(len(source_list), len(target_list))
+    pixels = opt.image_size * opt.image_size
+    nbytes = num_images * pixels * (opt.num_channels * (1 if opt.uint8_pipeline else 4) + opt.with_masks)
+    if nbytes <= opt.val_cache_mb * 2 ** 20:
+        ds = ds.cache()
+    else:
+        if opt.with_masks:
+            # masks are part of the cached elements, so their files key the cache along with the images
+            source_list = [p for pair in source_list for p in pair if p]
+            target_list = [p for pair in target_list for p in pair if p]
+        key = cache_key(source_list + target_list,
+                        f'{opt.image_size}_{opt.num_samples}_{opt.uint8_pipeline}_{opt.with_masks}', opt, mtimes)
+        path = f'{opt.cache_dir}/eval/{key}'
+        if not os.path.exists(f'{path}.index'):
+            fill_file_cache(ds, path)
+        return ds.cache(path).prefetch(AUTOTUNE)
+
+    # one full pass fills the cache, partial reads such as take() would otherwise discard it
+    for _ in ds:
+        pass
+    return ds.prefetch(AUTOTUNE)
+
+
+def fill_file_cache(ds, path):
+    # written under a per-process prefix and renamed once complete, with the index last, so an interrupted fill or
+    # a concurrent run never leaves a lockfile or a partial cache under path
+    tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        for _ in ds.cache(tmp):
+            pass
+        for pth in sorted(glob.glob(f'{tmp}*'), key=lambda p: p.endswith('.index')):
+            os.replace(pth, path + pth[len(tmp):])
+    finally:
+        for pth in glob.glob(f'{tmp}*'):
+            os.remove(pth)
+
+
+def build_unpaired_dataset(source_list, target_list, opt, mtimes):
+    # both domains are drawn independently and never run out, an epoch is opt.steps_per_epoch batches.
+    # the streams skip the opt.start_step batches already consumed before a restart
+    start = opt.start_step * opt.batch_size
+    ds_source = build_domain_dataset(source_list, opt, mtimes, True, unpaired=True, seed=opt.seed, start=start)
+    ds_target = build_domain_dataset(target_list, opt, mtimes, True, unpaired=True, seed=opt.seed + 1, start=start)
+    ds = tf.data.Dataset.zip((ds_source, ds_target)).batch(opt.batch_size, drop_remainder=True)
+    if batch_augmented(opt):
+        ds = ds.map(lambda xa, xb: (batch_augmentation(xa, opt), batch_augmentation(xb, opt)),
+                    num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+###Data state
+def data_state_path(opt, params):
+    return f"{opt.ckpt_dir}/{opt.model}/{params}/data_state.json"
+
+
+def load_data_state(opt, params):
+    # restores the sampler seed and the number of consumed batches saved with the last checkpoint
+    pth = data_state_path(opt, params)
+    if os.path.exists(pth):
+        with open(pth, 'r') as f:
+            state = json.load(f)
+        opt.seed = state['seed']
+        opt.start_step = state['step']
+    else:
+        opt.start_step = 0
+    return opt.start_step
 
 
 def build_dataset(opt, test=False):
     if test:
-        source_list = list(map(lambda x: f'{opt.source_test_dir}/{x}', os.listdir(opt.source_test_dir)))
-        target_list = list(map(lambda x: f'{opt.target_test_dir}/{x}', os.listdir(opt.target_test_dir)))
+        source_list, source_mtimes = list_images(opt.source_test_dir, opt)
+        target_list, target_mtimes = list_images(opt.target_test_dir, opt)
     else:
-        source_list = list(map(lambda x: f'{opt.source_dir}/{x}', os.listdir(opt.source_dir)))
-        target_list = list(map(lambda x: f'{opt.target_dir}/{x}', os.listdir(opt.target_dir)))
-    length = min(len(source_list), len(target_list))
-    source_list = source_list[:length]
-    target_list = target_list[:length]
+        source_list, source_mtimes = list_images(opt.source_dir, opt)
+        target_list, target_mtimes = list_images(opt.target_dir, opt)
+    mtimes = {**source_mtimes, **target_mtimes}
+
+    if opt.with_masks:
+        # lists of (image, mask) pairs from here on, so splits keep masks with their images
+        source_dir, target_dir = (opt.source_test_dir, opt.target_test_dir) if test else (opt.source_dir, opt.target_dir)
+        source_list = pair_masks(source_list, opt.source_mask_dir or f'{source_dir}_masks')
+        target_list = pair_masks(target_list, opt.target_mask_dir or f'{target_dir}_masks')
+
+    if opt.unpaired and not test:
+        source_train, source_val = ttp(source_list, test_size=opt.val_size, random_state=999, shuffle=True)
+        target_train, target_val = ttp(target_list, test_size=opt.val_size, random_state=999, shuffle=True)
+        if opt.steps_per_epoch == 0:
+            opt.steps_per_epoch = max(len(source_train), len(target_train)) // opt.batch_size
+        ds_train = build_unpaired_dataset(source_train, target_train, opt, mtimes)
+        ds_val = build_tf_dataset(source_val, target_val, opt, mtimes)
+        return ds_train, ds_val
+
+    if not opt.unpaired:
+        length = min(len(source_list), len(target_list))
+        source_list = source_list[:length]
+        target_list = target_list[:length]
 
     if not test:
         source_train, source_val, target_train, target_val = ttp(source_list, target_list, test_size=opt.val_size,
                                                              random_state=999, shuffle=True)
-        ds_train = build_tf_dataset(source_train, target_train, opt, True)
-        ds_val = build_tf_dataset(source_val, target_val, opt)
+        ds_train = build_tf_dataset(source_train, target_train, opt, mtimes, True)
+        ds_val = build_tf_dataset(source_val, target_val, opt, mtimes)
         return ds_train, ds_val
     else:
-        ds_test = build_tf_dataset(source_list, target_list, opt)
+        ds_test = build_tf_dataset(source_list, target_list, opt, mtimes)
         return ds_test
 
+
+def load_legacy_projection(model, ckpt):
+    # checkpoints written before the projection heads were fused keep one mlp_{i} Sequential per feature layer,
+    # their Dense weights are copied into the stacked head of the matching sampler (F, Fa, Fb)
+    pattern = re.compile(r'(\w+)/mlp_(\d+)/layer_with_weights-(\d)/(kernel|bias)/\.ATTRIBUTES/VARIABLE_VALUE$')
+    reader = tf.train.load_checkpoint(ckpt)
+    legacy = {}
+    for key in reader.get_variable_to_shape_map():
+        match = pattern.match(key)
+        if match:
+            name, feat_id, stage, kind = match.groups()
+            weights = legacy.setdefault(name, {}).setdefault(int(feat_id), [None] * 4)
+            weights[2 * int(stage) + (kind == 'bias')] = reader.get_tensor(key)
+
+    for name, weights in legacy.items():
+        sampler = getattr(model, name)
+        if not sampler.built:
+            sampler.build([tf.TensorShape([None, None, None, weights[i][0].shape[0]]) for i in sorted(weights)])
+            sampler.built = True
+        sampler.head.assign_legacy(weights)
+
+
+###Int8 frozen encoders
+def calibration_images(opt):
+    # a spread of local training images from both domains in [-1, 1], for post-training quantization
+    path_list = list_images(opt.source_dir, opt)[0] + list_images(opt.target_dir, opt)[0]
+    path_list = path_list[::max(1, len(path_list) // opt.calib_size)][:opt.calib_size]
+    return [(decode_image(pth, opt, opt.image_size).numpy() - 127.5) / 127.5 for pth in path_list]
+
+
+def quantize_encoders(model, opt, images):
+    # only encoders that take real images outside the gradient path can use the int8 model, and only in test_step
+    encoder = getattr(model, 'E', None)
+    if hasattr(encoder, 'quantizable'):
+        encoder.quantized = quantize_model(encoder.quantizable(), images, f'{opt.cache_dir}/int8', 'vgg')
+
+
+class TraceCounter(callbacks.Callback):
+    # traces of the keras train and test functions so far, logged every epoch. one per mode is expected
+    # while the batch shapes are relaxed, more means something in the step still depends on static shapes
+    def on_epoch_end(self, epoch, logs=None):
+        for mode in ['train', 'test']:
+            function = getattr(self.model, f'{mode}_function', None)
+            if hasattr(function, 'experimental_get_tracing_count'):
+                logs[f'{mode}_traces'] = function.experimental_get_tracing_count()
+
+
 def makecolorwheel():
     # Create a colorwheel for visualization
     RY = 15
@@ -166,6 +708,8 @@ def viz_flow(u, v, logscale=True, scaledown=6, output=False):
 class VisualizeCallback(callbacks.Callback):
     def __init__(self, source, target, opt, params):
         super().__init__()
+        if opt.with_masks:
+            (source, self.source_mask), (target, self.target_mask) = source, target
         self.source = source
         self.target = target
         self.opt = opt
@@ -175,7 +719,7 @@ class VisualizeCallback(callbacks.Callback):
         b, h, w, c = self.target.shape
 
         if self.opt.model == 'InfoMatch':
-            x2y_wrapped, grids = self.model.CP(self.source)
+            x2y_wrapped, grids = self.model.CP([self.source, self.target_mask])
             x2y, rxy = self.model.R(x2y_wrapped)
             grids = tf.transpose(grids, [0, 2, 3, 1])
 
@@ -191,6 +735,7 @@ class VisualizeCallback(callbacks.Callback):
 
         else:
             x2y = self.model.G(self.source)
+        x2y = tf.cast(x2y, 'float32')
 
         fig, ax = plt.subplots(ncols=b, nrows=5 if self.opt.model == 'InfoMatch' else 2, figsize=(16, 16))
 
@@ -220,7 +765,33 @@ class VisualizeCallback(callbacks.Callback):
         plt.savefig(f'{dir}/synthesis_{epoch}.jpg')
 
 
-def set_callbacks(opt, params, source, target, val_ds = None):
+class DataStateCallback(callbacks.Callback):
+    def __init__(self, opt, params):
+        super().__init__()
+        self.opt = opt
+        self.path = data_state_path(opt, params)
+        self.step = opt.start_step
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.batches += 1
+        if self.opt.save_freq and self.batches % self.opt.save_freq == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.opt.save_freq:
+            self.save()
+
+    def save(self):
+        # written at the same points as the ModelCheckpoint so the two always match
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump({'seed': self.opt.seed, 'step': self.step}, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+def set_callbacks(opt, params, source, target, val_ds = None, calibration = None):
     ckpt_dir = f"{opt.ckpt_dir}/{opt.model}"
     output_dir = f"{opt.output_dir}/{opt.model}"
 
@@ -230,8 +801,13 @@ def set_callbacks(opt, params, source, target, val_ds = None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    checkpoint_callback = callbacks.ModelCheckpoint(filepath=f"{ckpt_dir}/{params}/{opt.model}", save_weights_only=True)
+    checkpoint_callback = callbacks.ModelCheckpoint(filepath=f"{ckpt_dir}/{params}/{opt.model}", save_weights_only=True,
+                                                    save_freq=opt.save_freq if opt.save_freq else 'epoch')
     history_callback = callbacks.CSVLogger(f"{output_dir}/{params}.csv", separator=",", append=False)
     visualize_callback = VisualizeCallback(source, target, opt, params)
-    metrics_callback = metrics.MetricsCallbacks(val_ds, opt, params)
-    return [checkpoint_callback, history_callback, visualize_callback, metrics_callback]
+    metrics_callback = metrics.MetricsCallbacks(val_ds, opt, params, calibration=calibration)
+    # trace counts go into the logs before the csv logger writes them
+    callback_list = [TraceCounter(), checkpoint_callback, history_callback, visualize_callback, metrics_callback]
+    if opt.unpaired:
+        callback_list.insert(2, DataStateCallback(opt, params))
+    return callback_list